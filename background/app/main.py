@@ -17,16 +17,35 @@
 """
 
 # [START getting_started_background_app_main]
+import collections
+import datetime
+import hashlib
 import json
 import os
+import queue
+import threading
+import time
 
-from flask import Flask, redirect, render_template, request
+from flask import Flask, redirect, render_template, request, Response, url_for
+from flask_compress import Compress
 from google.cloud import firestore, pubsub
 from markupsafe import escape
 
 
 app = Flask(__name__)
 
+# Compress responses of at least COMPRESS_MIN_SIZE bytes with brotli or
+# gzip, whichever the browser accepts.
+app.config.update(
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    COMPRESS_MIN_SIZE=500,
+    # How long a stream of translation events stays open before the browser
+    # reconnects, and how long an idle stream waits between keepalives.
+    EVENT_STREAM_SECONDS=60,
+    EVENT_KEEPALIVE_SECONDS=15,
+)
+Compress(app)
+
 # Get client objects to reuse over multiple invocations
 db = firestore.Client()
 publisher = pubsub.PublisherClient()
@@ -36,6 +55,36 @@ ACCEPTABLE_LANGUAGES = ("de", "en", "es", "fr", "ja", "sw")
 # [END getting_started_background_app_main]
 
 
+# Fingerprints of the static files, by file name.
+_fingerprints = {}
+
+
+@app.template_global()
+def static_url(filename):
+    """Returns the URL of a static file, with a fingerprint of its contents
+    that changes whenever the file does.
+    """
+    fingerprint = _fingerprints.get(filename)
+    if fingerprint is None:
+        with app.open_resource(os.path.join("static", filename)) as f:
+            fingerprint = hashlib.sha1(f.read()).hexdigest()[:12]
+        _fingerprints[filename] = fingerprint
+    return url_for("static", filename=filename, v=fingerprint)
+
+
+@app.after_request
+def cache_static_files(response):
+    """Lets browsers cache fingerprinted static files for a year, since
+    their URL changes when they do.
+    """
+    if request.endpoint == "static" and "v" in request.args:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    return response
+
+
 # [START getting_started_background_app_list]
 @app.route("/", methods=["GET"])
 def index():
@@ -44,16 +93,184 @@ def index():
     """
 
     doc_list = []
+    # Translations written after the page was read are sent to the page by
+    # /translations/events, see translation_events().
+    read_time = datetime.datetime.now(datetime.timezone.utc)
     docs = db.collection("translations").stream()
     for doc in docs:
-        doc_list.append(doc.to_dict())
+        doc_list.append(dict(doc.to_dict(), id=doc.id))
+        read_time = doc.read_time
 
-    return render_template("index.html", translations=doc_list)
+    return render_template(
+        "index.html", translations=doc_list, since=_event_id(read_time)
+    )
 
 
 # [END getting_started_background_app_list]
 
 
+def _event_id(timestamp):
+    """Event ids are times in microseconds since the epoch."""
+    return int(timestamp.timestamp() * 1000000)
+
+
+class _Subscriber:
+    """The translations waiting to be sent to one connected browser."""
+
+    def __init__(self, max_pending, since):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        # The event id the browser has the translations up to, or None if
+        # it only wants the ones changed from now on.
+        self.since = since
+
+
+class TranslationWatch:
+    """Watches the translations collection with a single Firestore snapshot
+    listener, started by the first browser that connects, and passes new and
+    changed translations to every connected browser.
+
+    Translations are sent with their update time as the event id, and the
+    most recent ones are kept, so that a browser that reconnects, possibly
+    to another instance, gets the ones it missed.
+    """
+
+    def __init__(self, collection, history=100):
+        self._collection = collection
+        self._history = history
+        self._recent = collections.deque(maxlen=history)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._watch = None
+        self._initial = True
+        # The event id of the latest snapshot.
+        self.position = None
+
+    def subscribe(self, last_event_id=None):
+        """Returns a _Subscriber for the translations changed from now on,
+        or since ``last_event_id`` if it is recent enough.
+        """
+        subscriber = _Subscriber(self._history, last_event_id)
+        with self._lock:
+            if last_event_id is not None:
+                for event_id, translation in self._recent:
+                    if event_id > last_event_id:
+                        subscriber.queue.put_nowait((event_id, translation))
+            self._subscribers.add(subscriber)
+
+            # The listener keeps running while no one is connected, as
+            # starting it again reads the whole collection.
+            if self._watch is None or not self._watch.is_active:
+                if self._watch is not None:
+                    self._watch.unsubscribe()
+                self._initial = True
+                self._watch = self._collection.on_snapshot(self._on_snapshot)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            self.position = _event_id(read_time)
+            events = []
+            for change in changes:
+                if change.type.name == "REMOVED":
+                    continue
+                doc = change.document
+                translation = dict(doc.to_dict(), id=doc.id)
+                events.append((_event_id(doc.update_time), translation))
+
+            if self._initial:
+                # The first snapshot has every translation. Browsers only
+                # get the ones written after their page was read.
+                self._initial = False
+                events.sort(key=lambda event: event[0])
+                self._recent.extend(events)
+                for subscriber in list(self._subscribers):
+                    if subscriber.since is not None:
+                        for event in events:
+                            if event[0] > subscriber.since:
+                                self._send(subscriber, event)
+                return
+
+            self._recent.extend(events)
+            for event in events:
+                for subscriber in list(self._subscribers):
+                    self._send(subscriber, event)
+
+    def _send(self, subscriber, event):
+        try:
+            subscriber.queue.put_nowait(event)
+        except queue.Full:
+            # The browser stopped reading. When it reconnects, it gets what
+            # it missed from the recent ones.
+            subscriber.closed = True
+            self._subscribers.discard(subscriber)
+
+
+def get_translation_watch():
+    watch = app.extensions.get("translation_watch")
+    if watch is None:
+        watch = app.extensions.setdefault(
+            "translation_watch",
+            TranslationWatch(db.collection("translations")),
+        )
+    return watch
+
+
+@app.route("/translations/events", methods=["GET"])
+def translation_events():
+    """Streams new and changed translations as server-sent events, so the
+    list updates without reloading the page. The stream ends after
+    EVENT_STREAM_SECONDS and the browser opens a new one, sending the id of
+    the last event it got. Until it has one, it sends the time its page was
+    read as ``since``.
+    """
+    try:
+        last_event_id = int(
+            request.headers.get("Last-Event-ID") or request.args.get("since")
+        )
+    except (TypeError, ValueError):
+        last_event_id = None
+    watch = get_translation_watch()
+    subscriber = watch.subscribe(last_event_id)
+    duration = app.config["EVENT_STREAM_SECONDS"]
+    keepalive = app.config["EVENT_KEEPALIVE_SECONDS"]
+
+    def stream():
+        deadline = time.monotonic() + duration
+        try:
+            # A new browser starts from the latest snapshot.
+            if last_event_id is None and watch.position is not None:
+                yield f"retry: 1000\nid: {watch.position}\n\n"
+            else:
+                yield "retry: 1000\n\n"
+
+            while not subscriber.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    event_id, translation = subscriber.queue.get(
+                        timeout=min(keepalive, remaining)
+                    )
+                except queue.Empty:
+                    # A comment keeps proxies from closing an idle stream.
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {event_id}\ndata: {json.dumps(translation)}\n\n"
+        finally:
+            watch.unsubscribe(subscriber)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 # [START getting_started_background_app_request]
 @app.route("/request-translation", methods=["POST"])
 def translate():
@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import gzip
 import os
+import re
+from unittest import mock
 import uuid
 
 import google.auth
@@ -109,3 +113,117 @@ def test_translate(db, publisher, subscriber):
     assert len(response.received_messages) == 1
     assert b"This is a test" in response.received_messages[0].message.data
     assert b"fr" in response.received_messages[0].message.data
+
+
+def test_compression_and_static_caching(monkeypatch):
+    db = mock.Mock()
+    db.collection.return_value.stream.return_value = []
+    monkeypatch.setattr(main, "db", db)
+    client = main.app.test_client()
+
+    r = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["Content-Encoding"] == "gzip"
+
+    page = gzip.decompress(r.data).decode("utf-8")
+    script = re.search(r'<script defer src="([^"]+)"', page).group(1)
+    assert re.fullmatch(r"/static/app\.js\?v=[0-9a-f]{12}", script)
+    r = client.get(script)
+    assert r.status_code == 200
+    assert r.headers["Cache-Control"] == (
+        "public, max-age=31536000, immutable"
+    )
+    # Without the fingerprint, the file may change at the same URL.
+    r = client.get("/static/app.js")
+    assert "immutable" not in r.headers.get("Cache-Control", "")
+
+
+def _time(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+
+
+def _change(type_name, doc_id, seconds, fields):
+    change = mock.Mock()
+    change.type.name = type_name
+    change.document.id = doc_id
+    change.document.update_time = _time(seconds)
+    change.document.to_dict.return_value = fields
+    return change
+
+
+def test_translation_events(monkeypatch):
+    collection = mock.Mock()
+    watch = main.TranslationWatch(collection)
+    monkeypatch.setitem(main.app.extensions, "translation_watch", watch)
+    monkeypatch.setitem(main.app.config, "EVENT_STREAM_SECONDS", 0.1)
+
+    first = watch.subscribe()
+    second = watch.subscribe()
+    # Every browser shares one listener.
+    assert collection.on_snapshot.call_count == 1
+    on_snapshot = collection.on_snapshot.call_args[0][0]
+
+    # The first snapshot has the translations the page already shows.
+    on_snapshot(
+        [], [_change("ADDED", "a", 1, {"Translated": "Hallo"})], _time(1)
+    )
+    assert first.queue.empty()
+
+    on_snapshot(
+        [], [_change("MODIFIED", "a", 2, {"Translated": "Servus"})], _time(2)
+    )
+    for subscriber in (first, second):
+        assert subscriber.queue.get_nowait() == (
+            2000000,
+            {"Translated": "Servus", "id": "a"},
+        )
+
+    # A browser that reconnects gets the translations it missed.
+    client = main.app.test_client()
+    r = client.get(
+        "/translations/events", headers={"Last-Event-ID": "1000000"}
+    )
+    assert r.mimetype == "text/event-stream"
+    assert (
+        'id: 2000000\ndata: {"Translated": "Servus", "id": "a"}\n\n'
+        in r.get_data(as_text=True)
+    )
+    assert collection.on_snapshot.call_count == 1
+
+
+def test_translation_events_since_page(monkeypatch):
+    doc = mock.Mock(id="a", read_time=_time(1.5))
+    doc.to_dict.return_value = {"Translated": "Hallo"}
+    db = mock.Mock()
+    db.collection.return_value.stream.return_value = [doc]
+    monkeypatch.setattr(main, "db", db)
+    r = main.app.test_client().get("/")
+    assert 'data-since="1500000"' in r.get_data(as_text=True)
+
+    collection = mock.Mock()
+    watch = main.TranslationWatch(collection)
+    # The first browser starts the listener after its page was read.
+    subscriber = watch.subscribe(1500000)
+    on_snapshot = collection.on_snapshot.call_args[0][0]
+    on_snapshot(
+        [],
+        [
+            _change("ADDED", "a", 1, {"Translated": "Hallo"}),
+            _change("ADDED", "b", 2, {"Translated": "Salut"}),
+        ],
+        _time(2),
+    )
+    # Only the translation written since is sent, as the page has the other.
+    assert subscriber.queue.get_nowait() == (
+        2000000,
+        {"Translated": "Salut", "id": "b"},
+    )
+    assert subscriber.queue.empty()
+
+    # A later browser whose page was read before then gets it too.
+    monkeypatch.setitem(main.app.extensions, "translation_watch", watch)
+    monkeypatch.setitem(main.app.config, "EVENT_STREAM_SECONDS", 0.1)
+    r = main.app.test_client().get("/translations/events?since=1500000")
+    assert 'id: 2000000\ndata: {"Translated": "Salut", "id": "b"}' in (
+        r.get_data(as_text=True)
+    )
@@ -0,0 +1,87 @@
+/*
+ * Copyright 2019 Google LLC
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *     https://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+function showSnackbar(message, className) {
+    var snackbar = document.getElementById("snackbar");
+    snackbar.textContent = message;
+    snackbar.className = "active " + className;
+    clearTimeout(showSnackbar.timeout);
+    showSnackbar.timeout = setTimeout(function() {
+        snackbar.className = className;
+    }, 2750);
+}
+
+// Builds the table row of a translation, the same as the page does.
+function translationRow(translation) {
+    var row = document.createElement("tr");
+    row.dataset.id = translation.id;
+    [["OriginalLanguage", "Original", "chip"],
+     ["Language", "Translated", "chip accent"]].forEach(function(fields) {
+        var cell = document.createElement("td");
+        var chip = document.createElement("span");
+        chip.className = fields[2];
+        chip.textContent = translation[fields[0]];
+        cell.appendChild(chip);
+        cell.appendChild(document.createTextNode(" " + translation[fields[1]]));
+        row.appendChild(cell);
+    });
+    return row;
+}
+
+// Adds new translations to the list, and updates changed ones in place, as
+// the server sends them, starting with those written since the page was
+// read.
+function watchTranslations() {
+    var rows = document.getElementById("translations");
+    var events = new EventSource(
+        "/translations/events?since=" + encodeURIComponent(rows.dataset.since));
+    events.addEventListener("message", function(e) {
+        var translation = JSON.parse(e.data);
+        var row = translationRow(translation);
+        var existing = rows.querySelector(
+            'tr[data-id="' + CSS.escape(translation.id) + '"]');
+        if (existing) {
+            rows.replaceChild(row, existing);
+        } else {
+            rows.appendChild(row);
+        }
+    });
+}
+
+document.addEventListener("DOMContentLoaded", function() {
+    watchTranslations();
+
+    var form = document.getElementById("translate-form");
+    form.addEventListener("submit", function(e) {
+        e.preventDefault();
+        // Get value, make sure it's not empty.
+        if (document.getElementById("v").value == "") {
+            return;
+        }
+        fetch("/request-translation", {
+            method: "POST",
+            body: new URLSearchParams(new FormData(form))
+        }).then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            showSnackbar("Translation requested", "success");
+        }).catch(function() {
+            console.log("Error requesting translation");
+            showSnackbar("Translation request failed", "error");
+        });
+    });
+});
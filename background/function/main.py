@@ -20,13 +20,19 @@
     Language - the language to translate the string to
 
     The dictionary may have other fields, which will be ignored.
+
+    The TRANSLATION_OVERWRITE environment variable sets what happens when the
+    same string was already translated to the same language: 'keep' (the
+    default) leaves the stored translation, 'replace' overwrites it.
 """
 
 # [START getting_started_background_translate_setup]
 import base64
 import hashlib
 import json
+import os
 
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 from google.cloud import translate_v2 as translate
 # [END getting_started_background_translate_setup]
@@ -37,6 +43,12 @@ xlate = translate.Client()
 db = firestore.Client()
 # [END getting_started_background_translate_init]
 
+OVERWRITE_POLICIES = ('keep', 'replace')
+overwrite = os.environ.get('TRANSLATION_OVERWRITE', 'keep')
+if overwrite not in OVERWRITE_POLICIES:
+    raise ValueError('TRANSLATION_OVERWRITE must be one of {}, not {!r}'
+                     .format(', '.join(OVERWRITE_POLICIES), overwrite))
+
 
 # [START getting_started_background_translate_string]
 def translate_string(from_string, to_language):
@@ -58,8 +70,8 @@ def translate_string(from_string, to_language):
 def document_name(message):
     """ Messages are saved in a Firestore database with document IDs generated
         from the original string and destination language. If the exact same
-        translation is requested a second time, the result will overwrite the
-        prior result.
+        translation is requested a second time, it has the same name, and the
+        overwrite policy decides whether it replaces the prior result.
 
         message - a dictionary with fields named Language and Original, and
             optionally other fields with any names
@@ -74,17 +86,26 @@ def document_name(message):
     return name
 
 
-@firestore.transactional
-def update_database(transaction, message):
+def update_database(message, overwrite='keep'):
+    """ Saves the translation with a single write, without a transaction.
+
+        overwrite - 'keep' to only create the document, which fails on the
+            server if it already exists, or 'replace' to overwrite it
+
+        Returns True if the message was written
+    """
     name = document_name(message)
     doc_ref = db.collection('translations').document(document_id=name)
 
-    try:
-        doc_ref.get(transaction=transaction)
-    except firestore.NotFound:
-        return  # Don't replace an existing translation
+    if overwrite == 'replace':
+        doc_ref.set(message)
+        return True
 
-    transaction.set(doc_ref, message)
+    try:
+        doc_ref.create(message)
+    except AlreadyExists:
+        return False  # Don't replace an existing translation
+    return True
 
 
 def translate_message(event, context):
@@ -101,6 +122,5 @@ def translate_message(event, context):
     message['Translated'] = to_string
     message['OriginalLanguage'] = from_language
 
-    transaction = db.transaction()
-    update_database(transaction, message)
+    update_database(message, overwrite)
 # [END getting_started_background_translate]
@@ -52,3 +52,27 @@ def test_invocations():
     assert message['Language'] == 'de'
     assert len(message['Translated']) > 0
     assert message['OriginalLanguage'] == 'en'
+
+
+def test_overwrite_policy():
+    db = firestore.Client()
+    main.db = db
+
+    translations = db.collection('translations')
+    clear_collection(translations)
+
+    message = {
+        'Original': 'My test message',
+        'Language': 'de',
+        'Translated': 'Meine Testnachricht',
+        'OriginalLanguage': 'en',
+    }
+    doc_ref = translations.document(main.document_name(message))
+    retranslated = dict(message, Translated='Meine Testmeldung')
+
+    assert main.update_database(message)
+    assert not main.update_database(retranslated)
+    assert doc_ref.get().get('Translated') == 'Meine Testnachricht'
+
+    assert main.update_database(retranslated, overwrite='replace')
+    assert doc_ref.get().get('Translated') == 'Meine Testmeldung'
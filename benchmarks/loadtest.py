@@ -0,0 +1,617 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load tests the sample apps under gunicorn against the local Cloud emulators
+and records throughput and latency percentiles to a JSON file.
+
+To run the bookshelf app and save the results:
+
+    $ python benchmarks/loadtest.py run bookshelf --output before.json
+
+To compare two runs, failing if anything got slower by more than 10%:
+
+    $ python benchmarks/loadtest.py compare before.json after.json
+
+See benchmarks/README.md for the emulators each app needs.
+"""
+
+import argparse
+import collections
+import datetime
+import io
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import requests
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A 1x1 transparent PNG, uploaded by the "add" scenarios.
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc33000000'
+    '0049454e44ae426082')
+
+LANGUAGES = ('de', 'en', 'es', 'fr', 'ja', 'sw')
+
+
+# Emulators, by name: the environment variable the client libraries read to
+# find the emulator, the default port, and the gcloud command to start it.
+EMULATORS = {
+    'firestore': ('FIRESTORE_EMULATOR_HOST', 8086,
+                  ['gcloud', 'beta', 'emulators', 'firestore', 'start']),
+    'datastore': ('DATASTORE_EMULATOR_HOST', 8081,
+                  ['gcloud', 'beta', 'emulators', 'datastore', 'start',
+                   '--no-store-on-disk']),
+    'pubsub': ('PUBSUB_EMULATOR_HOST', 8085,
+               ['gcloud', 'beta', 'emulators', 'pubsub', 'start']),
+}
+
+
+class State(object):
+    """Data shared by the clients of one run, such as the ids of the books
+    that can be viewed."""
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.book_ids = []
+        self.session_ids = []
+
+    def add_book(self, response):
+        # The add form redirects to the new book.
+        location = response.headers.get('Location', '')
+        if response.status_code in (301, 302, 303) and '/books/' in location:
+            with self.lock:
+                self.book_ids.append(location.rstrip('/').rsplit('/', 1)[1])
+
+
+def _book_form(rng):
+    return {
+        'title': 'Load Test Book {}'.format(rng.randint(0, 10 ** 6)),
+        'author': 'Load Tester',
+        'publishedDate': '2019-01-01',
+        'description': 'A book added by the load test. ' * 4,
+    }
+
+
+def _add_book(prefix):
+    def add(session, url, state, rng):
+        files = None
+        if state.options.images:
+            files = {'image': ('cover.png', io.BytesIO(PNG), 'image/png')}
+        response = session.post(
+            url + prefix + '/add', data=_book_form(rng), files=files,
+            allow_redirects=False)
+        state.add_book(response)
+        return response
+    return add
+
+
+def _view_book(prefix):
+    def view(session, url, state, rng):
+        return session.get(
+            url + prefix + '/' + rng.choice(state.book_ids))
+    return view
+
+
+def _get(path):
+    def get(session, url, state, rng):
+        return session.get(url + path)
+    return get
+
+
+def _new_session(session, url, state, rng):
+    session.cookies.clear()
+    response = session.get(url + '/')
+    session_id = response.cookies.get('session_id')
+    if session_id:
+        with state.lock:
+            state.session_ids.append(session_id)
+    return response
+
+
+def _session_hit(session, url, state, rng):
+    session.cookies.clear()
+    return session.get(
+        url + '/', cookies={'session_id': rng.choice(state.session_ids)})
+
+
+def _request_translation(session, url, state, rng):
+    return session.post(
+        url + '/request-translation',
+        data={'v': 'Load test message {}'.format(rng.randint(0, 1000)),
+              'lang': rng.choice(LANGUAGES)},
+        allow_redirects=False)
+
+
+def _seed_books(prefix):
+    def seed(url, state):
+        rng = random.Random(0)
+        with requests.Session() as session:
+            for _ in range(state.options.seed):
+                response = session.post(
+                    url + prefix + '/add', data=_book_form(rng),
+                    allow_redirects=False)
+                response.raise_for_status()
+                state.add_book(response)
+        if not state.book_ids:
+            raise RuntimeError('Seeding did not create any books.')
+    return seed
+
+
+def _seed_sessions(url, state):
+    with requests.Session() as session:
+        for _ in range(state.options.seed):
+            _new_session(session, url, state, None)
+    if not state.session_ids:
+        raise RuntimeError('Seeding did not create any sessions.')
+
+
+def _seed_translations(url, state):
+    """Creates the translate topic and some prior translations in the
+    emulators, which the app expects to exist."""
+    project = os.environ['GOOGLE_CLOUD_PROJECT']
+    requests.put('http://{}/v1/projects/{}/topics/translate'.format(
+        os.environ['PUBSUB_EMULATOR_HOST'], project))
+
+    documents = 'http://{}/v1/projects/{}/databases/(default)/documents'
+    documents = documents.format(
+        os.environ['FIRESTORE_EMULATOR_HOST'], project)
+    for i in range(state.options.seed):
+        requests.post(
+            documents + '/translations',
+            params={'documentId': 'loadtest-{}'.format(i)},
+            json={'fields': {
+                'Original': {'stringValue': 'Message {}'.format(i)},
+                'Language': {'stringValue': 'fr'},
+                'Translated': {'stringValue': 'Message {} (fr)'.format(i)},
+                'OriginalLanguage': {'stringValue': 'en'},
+            }}).raise_for_status()
+
+
+# The apps, by name: the directory and WSGI app gunicorn runs, the emulators
+# it needs, a function that seeds data before the run, and the weighted
+# scenarios each simulated client picks from.
+APPS = {
+    'bookshelf': {
+        'dir': 'bookshelf',
+        'wsgi': 'main:app',
+        'emulators': ['firestore'],
+        'seed': _seed_books('/books'),
+        'scenarios': [
+            ('list', 6, _get('/')),
+            ('view', 6, _view_book('/books')),
+            ('add', 1, _add_book('/books')),
+        ],
+    },
+    'kubernetes-bookshelf': {
+        'dir': 'optional-kubernetes-engine',
+        'wsgi': 'main:app',
+        'emulators': ['datastore', 'pubsub'],
+        'seed': _seed_books('/books'),
+        'scenarios': [
+            ('list', 6, _get('/books/')),
+            ('view', 6, _view_book('/books')),
+            ('add', 1, _add_book('/books')),
+        ],
+    },
+    'sessions': {
+        'dir': 'sessions',
+        'wsgi': 'main:app',
+        'emulators': ['firestore'],
+        'seed': _seed_sessions,
+        'scenarios': [
+            ('new session', 1, _new_session),
+            ('session hit', 9, _session_hit),
+        ],
+    },
+    'background': {
+        'dir': 'background/app',
+        'wsgi': 'main:app',
+        'emulators': ['firestore', 'pubsub'],
+        'seed': _seed_translations,
+        'scenarios': [
+            ('list', 4, _get('/')),
+            ('request translation', 1, _request_translation),
+        ],
+    },
+}
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_port(host, port, timeout=60, process=None):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('Process exited with status {}'.format(
+                process.returncode))
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('Timed out waiting for {}:{}'.format(host, port))
+
+
+def start_emulators(names):
+    """
+    Starts the named emulators with gcloud unless their environment variable
+    is already set, in which case the running emulator is reset instead.
+    Returns the started processes and their environment variables.
+    """
+    started = []
+    for name in names:
+        variable, port, command = EMULATORS[name]
+        if variable not in os.environ:
+            host = 'localhost:{}'.format(port)
+            process = subprocess.Popen(
+                command + ['--host-port', host],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            started.append((process, variable))
+            _wait_for_port('localhost', port, process=process)
+            os.environ[variable] = host
+        _reset_emulator(name)
+    return started
+
+
+def stop_emulators(started):
+    for process, variable in started:
+        _stop(process)
+        del os.environ[variable]
+
+
+def _reset_emulator(name):
+    host = os.environ[EMULATORS[name][0]]
+    if name == 'firestore':
+        requests.delete(
+            'http://{}/emulator/v1/projects/{}/databases/(default)/'
+            'documents'.format(host, os.environ['GOOGLE_CLOUD_PROJECT']))
+    elif name == 'datastore':
+        requests.post('http://{}/reset'.format(host))
+
+
+def start_app(app, python, workers, threads):
+    """Runs the app under gunicorn on a free port. Returns the process and
+    the base URL."""
+    port = _free_port()
+    process = subprocess.Popen(
+        [python, '-m', 'gunicorn',
+         '--bind', '127.0.0.1:{}'.format(port),
+         '--workers', str(workers),
+         '--threads', str(threads),
+         app['wsgi']],
+        cwd=os.path.join(REPO_ROOT, app['dir']))
+    _wait_for_port('127.0.0.1', port, process=process)
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+
+def _stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the sorted ``values``."""
+    if not values:
+        return None
+    index = max(0, int(math.ceil(fraction * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, errors, duration):
+    """Summarizes a list of latencies in seconds as milliseconds."""
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / duration,
+    }
+    for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p95', 0.95),
+                           ('p99', 0.99), ('max', 1.0)):
+        value = percentile(latencies, fraction)
+        summary[name] = value * 1000 if value is not None else None
+    if latencies:
+        summary['mean'] = sum(latencies) / len(latencies) * 1000
+    else:
+        summary['mean'] = None
+    return summary
+
+
+def drive(url, scenarios, state, concurrency, duration, warmup, seed=0):
+    """
+    Runs ``concurrency`` clients against ``url`` for ``warmup`` plus
+    ``duration`` seconds. Each client repeatedly picks a scenario at random,
+    weighted by its weight. Only requests finishing after the warm up are
+    recorded.
+
+    A scenario that raises anything other than a failed request is counted
+    as an error too, and its traceback is printed after the run.
+
+    Returns a dict of summaries, by scenario name and ``total``.
+    """
+    names = [name for name, _, _ in scenarios]
+    weights = [weight for _, weight, _ in scenarios]
+    functions = dict((name, function) for name, _, function in scenarios)
+    results = dict((name, ([], [0])) for name in names)
+    failures = collections.Counter()
+    failures_lock = threading.Lock()
+
+    start = time.time() + warmup
+    deadline = start + duration
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        with requests.Session() as session:
+            while True:
+                name = rng.choices(names, weights)[0]
+                request_start = time.time()
+                try:
+                    response = functions[name](session, url, state, rng)
+                    ok = response.status_code < 400
+                except requests.RequestException:
+                    ok = False
+                except Exception:
+                    ok = False
+                    with failures_lock:
+                        failures[name, traceback.format_exc()] += 1
+                finished = time.time()
+                if finished >= deadline:
+                    return
+                if finished < start:
+                    continue
+                latencies, errors = results[name]
+                latencies.append(finished - request_start)
+                if not ok:
+                    errors[0] += 1
+
+    clients = [threading.Thread(target=client, args=(i,))
+               for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    for (name, trace), count in sorted(failures.items()):
+        sys.stderr.write('{} raised {} times:\n{}'.format(name, count, trace))
+
+    summaries = {}
+    all_latencies = []
+    all_errors = 0
+    for name, (latencies, errors) in results.items():
+        summaries[name] = summarize(latencies, errors[0], duration)
+        all_latencies.extend(latencies)
+        all_errors += errors[0]
+    summaries['total'] = summarize(all_latencies, all_errors, duration)
+    return summaries
+
+
+def _git_commit():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD'], cwd=REPO_ROOT) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_command(args):
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'loadtest')
+    settings = dict(
+        (name, getattr(args, name))
+        for name in ('concurrency', 'duration', 'warmup', 'workers',
+                     'threads', 'seed', 'images'))
+    commit = _git_commit()
+    output = args.output or 'loadtest-{}.json'.format(
+        commit[:12] if commit else int(time.time()))
+    report = {
+        'commit': commit,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'settings': settings,
+        'apps': {},
+    }
+
+    for name in args.apps:
+        app = APPS[name]
+        emulators = start_emulators(app['emulators'])
+        try:
+            if args.url:
+                process, url = None, args.url.rstrip('/')
+            else:
+                process, url = start_app(
+                    app, args.python, args.workers, args.threads)
+            try:
+                state = State(args)
+                app['seed'](url, state)
+                print('{}: running {} clients for {}s...'.format(
+                    name, args.concurrency, args.duration))
+                report['apps'][name] = drive(
+                    url, app['scenarios'], state, args.concurrency,
+                    args.duration, args.warmup)
+            finally:
+                if process is not None:
+                    _stop(process)
+        finally:
+            stop_emulators(emulators)
+
+        _print_summaries(report['apps'][name])
+
+    with io.open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Results written to {}'.format(output))
+
+
+def _format_number(value):
+    if value is None:
+        return '-'
+    if isinstance(value, int):
+        return str(value)
+    return '{:.1f}'.format(value)
+
+
+def _print_summaries(summaries):
+    print('  {:<22} {:>9} {:>7} {:>8} {:>8} {:>8}'.format(
+        '', 'req/sec', 'errors', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name in sorted(summaries, key=lambda name: (name == 'total', name)):
+        summary = summaries[name]
+        print('  {:<22} {:>9.1f} {:>7} {:>8} {:>8} {:>8}'.format(
+            name, summary['throughput'], summary['errors'],
+            _format_number(summary['p50']), _format_number(summary['p90']),
+            _format_number(summary['p99'])))
+
+
+def _change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / float(before)
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares two reports written by ``run``. Returns a list of rows of
+    (app, scenario, metric, baseline, current, change, regressed), one per
+    metric of each scenario present in both. A scenario regressed if its
+    throughput dropped, or its p50 or p99 latency grew, by more than
+    ``threshold``, or if it had errors that the baseline did not.
+    """
+    rows = []
+    for app, scenarios in sorted(current['apps'].items()):
+        for scenario, after in sorted(scenarios.items()):
+            before = baseline['apps'].get(app, {}).get(scenario)
+            if before is None:
+                continue
+            for metric, higher_is_worse in (('throughput', False),
+                                            ('p50', True), ('p99', True)):
+                change = _change(before[metric], after[metric])
+                worse = change if higher_is_worse else (
+                    -change if change is not None else None)
+                regressed = worse is not None and worse > threshold
+                rows.append((app, scenario, metric, before[metric],
+                             after[metric], change, regressed))
+            regressed = after['errors'] > 0 and before['errors'] == 0
+            rows.append((app, scenario, 'errors', before['errors'],
+                         after['errors'], None, regressed))
+    return rows
+
+
+def compare_command(args):
+    with io.open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with io.open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+
+    print('Baseline {}, current {}'.format(
+        baseline.get('commit'), current.get('commit')))
+    rows = compare(baseline, current, args.threshold)
+    print('{:<22} {:<22} {:<11} {:>10} {:>10} {:>8}'.format(
+        'app', 'scenario', 'metric', 'baseline', 'current', 'change'))
+    for app, scenario, metric, before, after, change, regressed in rows:
+        print('{:<22} {:<22} {:<11} {:>10} {:>10} {:>8}{}'.format(
+            app, scenario, metric,
+            _format_number(before), _format_number(after),
+            '{:+.1%}'.format(change) if change is not None else '',
+            '  REGRESSION' if regressed else ''))
+
+    regressions = sum(1 for row in rows if row[-1])
+    if regressions:
+        sys.exit('{} regression(s) beyond {:.0%}.'.format(
+            regressions, args.threshold))
+    print('No regressions beyond {:.0%}.'.format(args.threshold))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser(
+        'run', help='Load test one or more apps.')
+    run_parser.add_argument(
+        'apps', nargs='*', metavar='app',
+        help='Apps to test: {}. Defaults to all.'.format(
+            ', '.join(sorted(APPS))))
+    run_parser.add_argument(
+        '--output', help='JSON file to write the results to. Defaults to '
+        'loadtest-<commit>.json.')
+    run_parser.add_argument(
+        '--concurrency', type=int, default=8,
+        help='Number of simulated clients.')
+    run_parser.add_argument(
+        '--duration', type=float, default=30,
+        help='Seconds to record for, per app.')
+    run_parser.add_argument(
+        '--warmup', type=float, default=5,
+        help='Seconds to run before recording.')
+    run_parser.add_argument(
+        '--workers', type=int, default=2, help='gunicorn worker processes.')
+    run_parser.add_argument(
+        '--threads', type=int, default=4, help='gunicorn threads per worker.')
+    run_parser.add_argument(
+        '--seed', type=int, default=50,
+        help='Number of books, sessions or translations created first.')
+    run_parser.add_argument(
+        '--no-images', dest='images', action='store_false',
+        help="Don't upload a cover image with added books.")
+    run_parser.add_argument(
+        '--python', default=sys.executable,
+        help='Python interpreter with the app and gunicorn installed.')
+    run_parser.add_argument(
+        '--url', help='Test an app that is already running at this URL '
+        'instead of starting it.')
+    run_parser.set_defaults(func=run_command)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Relative change counted as a regression.')
+    compare_parser.set_defaults(func=compare_command)
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        for name in args.apps:
+            if name not in APPS:
+                parser.error('unknown app {!r}'.format(name))
+        args.apps = args.apps or sorted(APPS)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
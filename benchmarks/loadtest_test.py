@@ -0,0 +1,87 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+import loadtest
+
+
+Response = collections.namedtuple('Response', ['status_code'])
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 0.5) == 50
+    assert loadtest.percentile(values, 0.99) == 99
+    assert loadtest.percentile(values, 1.0) == 100
+    assert loadtest.percentile([7], 0.5) == 7
+    assert loadtest.percentile([], 0.5) is None
+
+
+def test_drive():
+    def ok(session, url, state, rng):
+        return Response(200)
+
+    def fail(session, url, state, rng):
+        return Response(500)
+
+    summaries = loadtest.drive(
+        'http://unused', [('ok', 1, ok), ('fail', 1, fail)], state=None,
+        concurrency=2, duration=0.2, warmup=0.05)
+
+    assert summaries['ok']['requests'] > 0
+    assert summaries['ok']['errors'] == 0
+    assert summaries['fail']['errors'] == summaries['fail']['requests']
+    assert summaries['total']['requests'] == (
+        summaries['ok']['requests'] + summaries['fail']['requests'])
+    assert summaries['ok']['p50'] <= summaries['ok']['p99']
+
+
+def test_drive_reports_exceptions(capsys):
+    def broken(session, url, state, rng):
+        return rng.choice([])
+
+    summaries = loadtest.drive(
+        'http://unused', [('broken', 1, broken)], state=None,
+        concurrency=2, duration=0.2, warmup=0)
+
+    # The clients kept going after the first exception.
+    assert summaries['broken']['requests'] > 2
+    assert summaries['broken']['errors'] == summaries['broken']['requests']
+    assert 'IndexError' in capsys.readouterr().err
+
+
+def _report(throughput, p50, p99, errors=0):
+    return {'apps': {'bookshelf': {'list': {
+        'throughput': throughput, 'p50': p50, 'p99': p99, 'errors': errors,
+    }}}}
+
+
+def test_compare():
+    baseline = _report(100, 10, 50)
+
+    rows = loadtest.compare(baseline, _report(95, 10.5, 54), 0.1)
+    assert not any(row[-1] for row in rows)
+
+    rows = loadtest.compare(baseline, _report(80, 10, 60, errors=3), 0.1)
+    regressed = set(row[2] for row in rows if row[-1])
+    assert regressed == set(['throughput', 'p99', 'errors'])
+
+
+def test_compare_skips_new_scenarios():
+    current = _report(100, 10, 50)
+    current['apps']['sessions'] = {'total': current['apps']['bookshelf'][
+        'list']}
+    rows = loadtest.compare(_report(100, 10, 50), current, 0.1)
+    assert set(row[0] for row in rows) == set(['bookshelf'])
@@ -0,0 +1,100 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the bytes on the wire needed to load a page: the page itself and
+the stylesheets and scripts it references, including those on other hosts.
+Each resource is fetched without compression and with gzip and brotli.
+
+For example, with the background app running locally:
+
+    $ python benchmarks/page_weight.py http://localhost:8080/
+"""
+
+import argparse
+from html.parser import HTMLParser
+import urllib.parse
+
+import requests
+
+
+ENCODINGS = ('identity', 'gzip', 'br')
+
+
+class _AssetParser(HTMLParser):
+    """Collects the URLs of the stylesheets and scripts in a page."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'link' and attrs.get('rel') == 'stylesheet':
+            self.urls.append(attrs.get('href'))
+        elif tag == 'script' and attrs.get('src'):
+            self.urls.append(attrs['src'])
+
+
+def transfer_size(session, url, encoding):
+    """Returns the size of the response body as sent, before decoding,
+    and the body's content encoding."""
+    response = session.get(
+        url, headers={'Accept-Encoding': encoding}, stream=True)
+    response.raise_for_status()
+    body = response.raw.read(decode_content=False)
+    return len(body), response.headers.get('Content-Encoding', 'identity')
+
+
+def measure(url):
+    """Returns a list of (url, {encoding: (bytes, content encoding)}) for
+    the page and each of its assets."""
+    with requests.Session() as session:
+        page = session.get(url)
+        page.raise_for_status()
+        parser = _AssetParser()
+        parser.feed(page.text)
+
+        urls = [url] + [urllib.parse.urljoin(url, asset)
+                        for asset in parser.urls if asset]
+        return [
+            (resource, dict((encoding, transfer_size(
+                session, resource, encoding)) for encoding in ENCODINGS))
+            for resource in urls]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('urls', nargs='+', metavar='url')
+    args = parser.parse_args()
+
+    for url in args.urls:
+        print(url)
+        totals = dict((encoding, 0) for encoding in ENCODINGS)
+        for resource, sizes in measure(url):
+            columns = []
+            for encoding in ENCODINGS:
+                size, applied = sizes[encoding]
+                totals[encoding] += size
+                columns.append('{:>9} {:<8}'.format(size, applied))
+            print('  {:<60} {}'.format(resource[-60:], ' '.join(columns)))
+        print('  {:<60} {}'.format('total', ' '.join(
+            '{:>9} {:<8}'.format(totals[encoding], '')
+            for encoding in ENCODINGS)))
+
+
+if __name__ == '__main__':
+    main()
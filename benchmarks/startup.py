@@ -0,0 +1,127 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how long the sample apps take to start: the time to import the
+app's module in a new interpreter, and the time from starting gunicorn to
+the app's first response. These are what a new App Engine or Cloud Run
+instance spends before it can serve traffic.
+
+    $ python benchmarks/startup.py bookshelf --runs 5
+
+The apps run against the local Cloud emulators, like in loadtest.py.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import loadtest
+import requests
+
+
+# Prints how long importing the module named by the first argument takes.
+IMPORT_TIME = '''
+import sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(time.perf_counter() - start)
+'''
+
+
+def import_time(app, python):
+    """Returns the seconds taken to import the app's module in a new
+    interpreter."""
+    module = app['wsgi'].split(':')[0]
+    output = subprocess.check_output(
+        [python, '-c', IMPORT_TIME, module],
+        cwd=os.path.join(loadtest.REPO_ROOT, app['dir']))
+    return float(output.decode().split()[-1])
+
+
+def first_response_time(app, python, timeout=60):
+    """Starts the app under gunicorn with one worker and returns the seconds
+    until it first answers a request for /."""
+    port = loadtest._free_port()
+    url = 'http://127.0.0.1:{}/'.format(port)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [python, '-m', 'gunicorn', '--bind', '127.0.0.1:{}'.format(port),
+         '--workers', '1', app['wsgi']],
+        cwd=os.path.join(loadtest.REPO_ROOT, app['dir']),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError('gunicorn exited with status {}'.format(
+                    process.returncode))
+            try:
+                # Redirects are answers from the app too.
+                requests.get(url, allow_redirects=False, timeout=timeout)
+                return time.perf_counter() - start
+            except requests.ConnectionError:
+                time.sleep(0.01)
+        raise RuntimeError('Timed out waiting for {}'.format(url))
+    finally:
+        loadtest._stop(process)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'apps', nargs='*', metavar='app',
+        help='Apps to measure: {}. Defaults to all.'.format(
+            ', '.join(sorted(loadtest.APPS))))
+    parser.add_argument(
+        '--runs', type=int, default=5, help='Measurements per app.')
+    parser.add_argument(
+        '--python', default=sys.executable,
+        help='Python interpreter with the app and gunicorn installed.')
+    args = parser.parse_args()
+    for name in args.apps:
+        if name not in loadtest.APPS:
+            parser.error('unknown app {!r}'.format(name))
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'loadtest')
+
+    print('{:<22} {:>12} {:>12} {:>16} {:>16}'.format(
+        'app', 'import p50', 'import max', 'response p50', 'response max'))
+    for name in args.apps or sorted(loadtest.APPS):
+        app = loadtest.APPS[name]
+        emulators = loadtest.start_emulators(app['emulators'])
+        try:
+            imports = [import_time(app, args.python)
+                       for _ in range(args.runs)]
+            responses = [first_response_time(app, args.python)
+                         for _ in range(args.runs)]
+        finally:
+            loadtest.stop_emulators(emulators)
+        print('{:<22} {:>10.0f}ms {:>10.0f}ms {:>14.0f}ms {:>14.0f}ms'.format(
+            name, _median(imports) * 1000, max(imports) * 1000,
+            _median(responses) * 1000, max(responses) * 1000))
+
+
+if __name__ == '__main__':
+    main()
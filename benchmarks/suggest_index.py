@@ -0,0 +1,101 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the bookshelf app's title index with made up titles: how long the
+titles take to save, the size of the saved file, the memory a process uses
+to map it, and how long lookups and writes take. Run it with the bookshelf
+app's requirements installed:
+
+    $ python benchmarks/suggest_index.py --titles 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bookshelf'))
+
+import suggest  # noqa: E402
+
+
+WORDS = ('the', 'of', 'a', 'night', 'river', 'garden', 'house', 'war',
+         'stars', 'winter', 'secret', 'history', 'last', 'little', 'city',
+         'dragon', 'glass', 'silent', 'iron', 'summer', 'king', 'road')
+
+
+def make_books(count, rng):
+    for i in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(2, 6))]
+        yield {'id': '{:020d}'.format(i),
+               'title': ' '.join(words).title()}
+
+
+def _microseconds(f, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    books = list(make_books(args.titles, rng))
+    titles = [(book['id'], book['title']) for book in books]
+    path = os.path.join(tempfile.mkdtemp(), 'titles')
+
+    start = time.perf_counter()
+    suggest.save(path, titles, time.time())
+    save_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    index = suggest.TitleIndex()
+    start = time.perf_counter()
+    index.load(path)
+    load_seconds = time.perf_counter() - start
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('titles            {:>12,}'.format(len(index)))
+    print('save              {:>12.2f} s'.format(save_seconds))
+    print('file              {:>12.1f} MB'.format(
+        os.path.getsize(path) / 1e6))
+    print('load              {:>12.1f} ms'.format(load_seconds * 1000))
+    print('memory            {:>12.1f} kB'.format(memory / 1e3))
+
+    prefixes = [rng.choice(WORDS)[:rng.randint(1, 4)]
+                for _ in range(args.lookups)]
+    prefixes = iter(prefixes * 2)
+    print('suggest           {:>12.1f} us'.format(_microseconds(
+        lambda: index.suggest(next(prefixes)), args.lookups)))
+
+    ids = iter(range(args.lookups))
+    print('update            {:>12.1f} us'.format(_microseconds(
+        lambda: index.update('{:020d}'.format(next(ids)),
+                             {'title': 'Winter Road'}), args.lookups)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how many translations per second the background function saves to
+Firestore: with the transaction it used to save them in, and with the single
+create, or set when replacing, that it uses now. Each is run with new
+translations and again with the same ones, which already exist.
+
+The translation itself isn't called, as it is the same for all of them. Run
+it with the function's requirements installed, against the Firestore
+emulator like in loadtest.py:
+
+    $ python benchmarks/translation_writes.py --messages 2000 --threads 16
+
+The function creates its Translation client when imported, which needs
+application default credentials.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import threading
+import time
+
+from google.cloud import firestore
+import loadtest
+
+sys.path.insert(0, os.path.join(loadtest.REPO_ROOT, 'background', 'function'))
+
+
+def transactional_save(function):
+    """Returns how the function saved translations before: reading the
+    document and setting it in a transaction."""
+    @firestore.transactional
+    def update_database(transaction, message):
+        name = function.document_name(message)
+        doc_ref = function.db.collection('translations').document(
+            document_id=name)
+        doc_ref.get(transaction=transaction)
+        transaction.set(doc_ref, message)
+
+    def save(message):
+        update_database(function.db.transaction(), message)
+    return save
+
+
+def make_messages(count):
+    return [{'Original': 'Message {}'.format(i),
+             'Language': loadtest.LANGUAGES[i % len(loadtest.LANGUAGES)],
+             'Translated': 'Translated message {}'.format(i),
+             'OriginalLanguage': 'en'}
+            for i in range(count)]
+
+
+def measure(save, messages, threads):
+    """Saves the messages from ``threads`` threads at once, like concurrent
+    function instances. Returns the messages saved per second and the
+    sorted latencies in seconds."""
+    pending = iter(messages)
+    lock = threading.Lock()
+    latencies = []
+
+    def run():
+        while True:
+            with lock:
+                message = next(pending, None)
+            if message is None:
+                return
+            start = time.perf_counter()
+            save(message)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return len(messages) / elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'loadtest')
+
+    emulators = loadtest.start_emulators(['firestore'])
+    try:
+        # The function creates its Firestore client when imported, so it
+        # has to find the emulator by then.
+        function = importlib.import_module('main')
+        saves = [
+            ('transaction', transactional_save(function)),
+            ('create', lambda message: function.update_database(message)),
+            ('replace', lambda message: function.update_database(
+                message, overwrite='replace')),
+        ]
+        messages = make_messages(args.messages)
+
+        print('{:<12} {:<8} {:>12} {:>10} {:>10}'.format(
+            '', '', 'messages/s', 'p50', 'p99'))
+        for name, save in saves:
+            loadtest._reset_emulator('firestore')
+            for case in ('new', 'existing'):
+                per_second, latencies = measure(save, messages, args.threads)
+                print('{:<12} {:<8} {:>12.0f} {:>8.1f}ms {:>8.1f}ms'.format(
+                    name, case, per_second,
+                    loadtest.percentile(latencies, 0.5) * 1000,
+                    loadtest.percentile(latencies, 0.99) * 1000))
+    finally:
+        loadtest.stop_emulators(emulators)
+
+
+if __name__ == '__main__':
+    main()
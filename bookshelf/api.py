@@ -0,0 +1,167 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON API for the books, alongside the HTML pages.
+
+    GET    /api/books?limit=10&cursor=...   A page of books, by title.
+    GET    /api/books/batch?ids=a,b,c       Several books by id.
+    GET    /api/books/<id>                  One book.
+    POST   /api/books                       Create a book.
+    PUT    /api/books/<id>                  Replace a book.
+    DELETE /api/books/<id>                  Delete a book.
+
+The GET requests accept ``fields=title,author`` to only read and return
+those fields. Books always include their ``id``.
+
+Books also have a ``version``, which every write increments. A PUT that
+includes the version it read only replaces the book if it is still at that
+version, and fails with a 409 otherwise.
+"""
+
+import firestore
+from flask import Blueprint, jsonify, request, url_for
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
+
+
+api = Blueprint('api', __name__)
+
+# Fields a book can have, besides its id.
+BOOK_FIELDS = ('title', 'author', 'publishedDate', 'imageUrl', 'description')
+
+# Fields set by the app, which clients can read but not write.
+READ_ONLY_FIELDS = ('id', 'version')
+
+MAX_LIMIT = 100
+MAX_BATCH = 100
+
+
+def _list_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item for item in value.split(',') if item]
+
+
+def _fields():
+    fields = _list_arg('fields')
+    if fields is None:
+        return None
+    unknown = set(fields) - set(BOOK_FIELDS) - set(READ_ONLY_FIELDS)
+    if unknown:
+        raise BadRequest('Unknown fields: {}'.format(
+            ', '.join(sorted(unknown))))
+    # The id is not a stored field, it is always returned.
+    return [field for field in fields if field != 'id']
+
+
+def _project(book, fields):
+    """Drops the fields that weren't asked for, which the query may have
+    read anyway."""
+    if fields is None:
+        return book
+    projected = dict((k, v) for k, v in book.items() if k in fields)
+    projected['id'] = book['id']
+    return projected
+
+
+def _book_data():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise BadRequest('Expected a JSON object.')
+    unknown = set(data) - set(BOOK_FIELDS) - set(READ_ONLY_FIELDS)
+    if unknown:
+        raise BadRequest('Unknown fields: {}'.format(
+            ', '.join(sorted(unknown))))
+    return dict((k, v) for k, v in data.items() if k not in READ_ONLY_FIELDS)
+
+
+def _version():
+    """Returns the version the client read of the book it is replacing, or
+    None if it didn't send one."""
+    version = request.get_json().get('version')
+    if version is not None and (
+            not isinstance(version, int) or isinstance(version, bool)):
+        raise BadRequest('version must be an integer')
+    return version
+
+
+@api.route('/books')
+def list_books():
+    fields = _fields()
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        raise BadRequest('limit must be an integer')
+    if not 1 <= limit <= MAX_LIMIT:
+        raise BadRequest('limit must be between 1 and {}'.format(MAX_LIMIT))
+
+    books, next_cursor = firestore.next_page(
+        limit=limit, start_after=request.args.get('cursor'), fields=fields)
+    return jsonify(
+        books=[_project(book, fields) for book in books],
+        next_cursor=next_cursor)
+
+
+@api.route('/books/batch')
+def batch_get_books():
+    fields = _fields()
+    ids = _list_arg('ids')
+    if not ids:
+        raise BadRequest('ids is required')
+    if len(ids) > MAX_BATCH:
+        raise BadRequest('At most {} ids can be read at once'.format(
+            MAX_BATCH))
+
+    books = firestore.read_multi(ids, fields=fields)
+    return jsonify(books=[
+        _project(book, fields) if book is not None else None
+        for book in books])
+
+
+@api.route('/books/<book_id>')
+def get_book(book_id):
+    fields = _fields()
+    book = firestore.read(book_id, fields=fields)
+    if book is None:
+        raise NotFound('No book with id {}'.format(book_id))
+    return jsonify(_project(book, fields))
+
+
+@api.route('/books', methods=['POST'])
+def create_book():
+    book = firestore.create(_book_data())
+    response = jsonify(book)
+    response.status_code = 201
+    response.headers['Location'] = url_for(
+        '.get_book', book_id=book['id'])
+    return response
+
+
+@api.route('/books/<book_id>', methods=['PUT'])
+def update_book(book_id):
+    return jsonify(firestore.update(_book_data(), book_id, version=_version()))
+
+
+@api.route('/books/<book_id>', methods=['DELETE'])
+def delete_book(book_id):
+    firestore.delete(book_id)
+    return '', 204
+
+
+@api.errorhandler(HTTPException)
+def handle_http_error(e):
+    response = jsonify(error=e.description)
+    response.status_code = e.code
+    return response
@@ -0,0 +1,181 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Caching for the book pages.
+
+Each page gets an ETag computed from the templates and the data it shows, so
+a browser or CDN revalidating a page that hasn't changed gets a 304 Not
+Modified without the template being rendered.
+
+Rendered pages are also kept in memory under their ETag, and the list entry
+of each book under the book's id and a hash of its contents, so that
+unchanged pages and books aren't rendered twice. Writes made through
+firestore.py evict the entries they affect. Because the entries are keyed by
+content, a write made by another process can't cause a stale page to be
+served.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+
+import firestore
+from flask import current_app, request, session
+from markupsafe import Markup
+
+
+class LRUCache(object):
+    """A thread-safe mapping holding up to ``max_entries`` values, which
+    evicts the least recently used value when full."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _digest(data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True, default=str).encode('utf-8'))
+
+
+def _templates_digest():
+    """Returns a digest of the source of every template, so that ETags and
+    cached pages change when the templates are deployed."""
+    digest = current_app.extensions.get('templates_digest')
+    if digest is None:
+        env = current_app.jinja_env
+        sha = hashlib.sha1()
+        for name in sorted(env.list_templates()):
+            sha.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        digest = current_app.extensions['templates_digest'] = sha.hexdigest()
+    return digest
+
+
+def page_etag(template, context):
+    """Returns the ETag of ``template`` rendered with ``context``."""
+    return _digest([_templates_digest(), template, context]).hexdigest()
+
+
+def book_media(book):
+    """
+    Returns the list entry for ``book``, rendered from book_media.html. The
+    rendering is reused for as long as the book is unchanged.
+    """
+    fragments = current_app.extensions['fragment_cache']
+    version = _digest(book).hexdigest()
+
+    cached = fragments.get(book['id'])
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    html = Markup(current_app.jinja_env.get_template(
+        'book_media.html').render(book=book))
+    fragments.set(book['id'], (version, html))
+    return html
+
+
+def _matching_etag(etag):
+    """
+    Returns the tag in the request's If-None-Match header matching ``etag``,
+    or None. Compressed responses have the encoding appended to their ETag,
+    as in "etag:gzip", which still matches.
+    """
+    if_none_match = request.if_none_match
+    if if_none_match.contains(etag):
+        return etag
+    for tag in if_none_match:
+        if tag.split(':', 1)[0] == etag:
+            return tag
+    return None
+
+
+def render_page(render, template, max_age, **context):
+    """
+    Returns the response for ``template`` rendered with ``context`` by
+    ``render``, with an ETag and a Cache-Control header allowing caches to
+    keep it for ``max_age`` seconds. With a ``max_age`` of 0, caches must
+    revalidate the page on every request. If the request's If-None-Match
+    header matches, returns 304 Not Modified without rendering the template.
+    """
+    # Flashed messages are shown once to one user, so pages showing them
+    # are never cached.
+    if session.get('_flashes'):
+        response = current_app.make_response(render(template, **context))
+        response.cache_control.no_store = True
+        return response
+
+    etag = page_etag(template, context)
+    client_etag = _matching_etag(etag)
+    if client_etag is not None:
+        response = current_app.response_class(status=304)
+        etag = client_etag
+    else:
+        pages = current_app.extensions['page_cache']
+        body = pages.get(etag)
+        if body is None:
+            body = render(template, **context)
+            pages.set(etag, body)
+        response = current_app.make_response(body)
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def init_app(app):
+    """Sets up the page and list entry caches for app."""
+    pages = LRUCache(app.config['PAGE_CACHE_SIZE'])
+    fragments = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+    app.extensions['page_cache'] = pages
+    app.extensions['fragment_cache'] = fragments
+    app.jinja_env.globals['book_media'] = book_media
+
+    def evict(book_id, book):
+        fragments.pop(book_id)
+        # Any list page may show the book, or shift because of it.
+        pages.clear()
+
+    firestore.add_write_listener(evict)
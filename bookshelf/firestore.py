@@ -12,9 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from google.api_core import exceptions
 # [START bookshelf_firestore_client_import]
 from google.cloud import firestore
 # [END bookshelf_firestore_client_import]
+import metrics
+from werkzeug.exceptions import Conflict, NotFound
+
+
+# Called with (book_id, book) after every write, see add_write_listener.
+_write_listeners = []
+
+
+def add_write_listener(listener):
+    """
+    Calls ``listener(book_id, book)`` after every write made through this
+    module, with ``book`` set to None when the book was deleted. Writes made
+    by other processes are not seen.
+    """
+    _write_listeners.append(listener)
+
+
+def _notify(book_id, book):
+    for listener in _write_listeners:
+        listener(book_id, book)
 
 
 def document_to_dict(doc):
@@ -25,11 +46,21 @@ def document_to_dict(doc):
     return doc_dict
 
 
-def next_page(limit=10, start_after=None):
+@metrics.timed('firestore.next_page')
+def next_page(limit=10, start_after=None, fields=None):
+    """
+    Returns a page of up to ``limit`` books ordered by title, and the title
+    to pass as ``start_after`` to get the next page, or None. If ``fields``
+    is given, only those fields and the title are read.
+    """
     db = firestore.Client()
 
     query = db.collection(u'Book').limit(limit).order_by(u'title')
 
+    if fields is not None:
+        # The title is the cursor for the next page.
+        query = query.select(sorted(set(fields) | set([u'title'])))
+
     if start_after:
         # Construct a new query starting at this document.
         query = query.start_after({u'title': start_after})
@@ -44,26 +75,126 @@ def next_page(limit=10, start_after=None):
     return docs, last_title
 
 
-def read(book_id):
+def iterate(batch_size=1000, fields=None):
+    """Yields every book, fetching ``batch_size`` books per query. If
+    ``fields`` is given, only those fields are read."""
+    db = firestore.Client()
+
+    query = (db.collection(u'Book')
+             .order_by(firestore.FieldPath.document_id())
+             .limit(batch_size))
+    if fields is not None:
+        query = query.select(fields)
+    last_doc = None
+
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+
+        for doc in docs:
+            yield document_to_dict(doc)
+
+        if len(docs) < batch_size:
+            return
+        last_doc = docs[-1]
+
+
+@metrics.timed('firestore.read')
+def read(book_id, fields=None):
+    """Returns the book, or None. If ``fields`` is given, only those fields
+    are read."""
     # [START bookshelf_firestore_client]
     db = firestore.Client()
     book_ref = db.collection(u'Book').document(book_id)
-    snapshot = book_ref.get()
+    snapshot = book_ref.get(field_paths=fields)
     # [END bookshelf_firestore_client]
     return document_to_dict(snapshot)
 
 
-def update(data, book_id=None):
+@metrics.timed('firestore.read_multi')
+def read_multi(book_ids, fields=None):
+    """
+    Reads several books in one round trip. Returns the books in the order of
+    ``book_ids``, with None for books that don't exist. If ``fields`` is
+    given, only those fields are read.
+    """
+    db = firestore.Client()
+    books = db.collection(u'Book')
+    refs = [books.document(book_id) for book_id in book_ids]
+
+    # get_all returns the documents in no particular order.
+    found = {}
+    for snapshot in db.get_all(refs, field_paths=fields):
+        if snapshot.exists:
+            found[snapshot.id] = document_to_dict(snapshot)
+    return [found.get(book_id) for book_id in book_ids]
+
+
+@metrics.timed('firestore.update')
+def update(data, book_id=None, version=None):
+    """
+    Replaces the book with ``data``, or creates a new book if ``book_id`` is
+    None, and returns the stored book. Every write increments the book's
+    ``version``, which is 0 for books stored before books had one. Only the
+    fields that differ from the stored book are written. NotFound is raised
+    if there is no book with ``book_id``.
+
+    If ``version`` is given, the book is only written if it is still at that
+    version, and Conflict is raised if it was changed since. Without it, the
+    write replaces whatever is stored.
+    """
     db = firestore.Client()
     book_ref = db.collection(u'Book').document(book_id)
-    book_ref.set(data)
-    return document_to_dict(book_ref.get())
+
+    if book_id is None:
+        book = dict(data, version=1)
+        book_ref.create(book)
+        book['id'] = book_ref.id
+        _notify(book['id'], book)
+        return book
+
+    while True:
+        snapshot = book_ref.get()
+        current = snapshot.to_dict()
+        if current is None:
+            raise NotFound('No book with id {}'.format(book_id))
+        current_version = current.get('version', 0)
+        if version is not None and current_version != version:
+            raise Conflict('Book {} is no longer at version {}'.format(
+                book_id, version))
+
+        book = dict(data)
+        book['version'] = current_version + 1
+        # update() only sends the fields that changed, and is only applied
+        # if the book wasn't written or deleted since it was read, so the
+        # fields missing from data are deleted explicitly.
+        changes = dict((field, firestore.DELETE_FIELD)
+                       for field in current if field not in book)
+        changes.update(
+            (field, value) for field, value in book.items()
+            if field not in current or current[field] != value)
+        try:
+            book_ref.update(changes, option=db.write_option(
+                last_update_time=snapshot.update_time))
+            break
+        except (exceptions.Conflict, exceptions.FailedPrecondition,
+                exceptions.NotFound):
+            if version is not None:
+                raise Conflict('Book {} was changed by another write'.format(
+                    book_id))
+            # Another write got in between, read the book again.
+
+    book['id'] = book_ref.id
+    _notify(book['id'], book)
+    return book
 
 
 create = update
 
 
+@metrics.timed('firestore.delete')
 def delete(id):
     db = firestore.Client()
     book_ref = db.collection(u'Book').document(id)
     book_ref.delete()
+    _notify(id, None)
@@ -12,14 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import os
+import threading
+import time
+import zlib
 
+import api
+import caching
 import firestore
-from flask import current_app, flash, Flask, Markup, redirect, render_template
-from flask import request, url_for
-from google.cloud import error_reporting
-import google.cloud.logging
+import flask
+from flask import current_app, flash, Flask, Markup, redirect
+from flask import request, Response, stream_with_context, url_for
+from flask_compress import Compress
+import metrics
+import search
 import storage
+import suggest
+from werkzeug.exceptions import BadRequest, Conflict, ServiceUnavailable
+
+
+# Template rendering is timed along with the Firestore and Cloud Storage
+# calls.
+render_template = metrics.timed('render_template')(flask.render_template)
 
 
 # [START upload_image_file]
@@ -48,18 +64,82 @@ app = Flask(__name__)
 app.config.update(
     SECRET_KEY='secret',
     MAX_CONTENT_LENGTH=8 * 1024 * 1024,
-    ALLOWED_EXTENSIONS=set(['png', 'jpg', 'jpeg', 'gif'])
+    ALLOWED_EXTENSIONS=set(['png', 'jpg', 'jpeg', 'gif']),
+    # How long browsers and CDNs may cache the book list and book pages, in
+    # seconds. With 0, they keep the pages but revalidate them on every
+    # request, which is answered with 304 Not Modified if nothing changed.
+    LIST_CACHE_MAX_AGE=0,
+    VIEW_CACHE_MAX_AGE=0,
+    # Number of rendered pages, and of rendered book list entries, kept in
+    # memory by each process.
+    PAGE_CACHE_SIZE=1000,
+    FRAGMENT_CACHE_SIZE=10000,
+    # Compress responses of at least COMPRESS_MIN_SIZE bytes with brotli or
+    # gzip, whichever the browser accepts. The export is streamed and
+    # compresses itself.
+    COMPRESS_ALGORITHM=['br', 'gzip'],
+    COMPRESS_MIN_SIZE=500,
+    COMPRESS_STREAMS=False,
+    # Token that requests to /metrics must send in an "Authorization: Bearer
+    # <token>" header. Without one, the metrics aren't served.
+    METRICS_TOKEN=os.environ.get('METRICS_TOKEN'),
+    # Where `flask build-indexes` saves the search index, by default in the
+    # temporary directory, and how often each process checks it for a newer
+    # one. Every process that serves searches must be able to read it, so
+    # with several machines, point it at a shared volume.
+    SEARCH_INDEX_PATH=os.environ.get('SEARCH_INDEX_PATH'),
+    SEARCH_INDEX_REFRESH_SECONDS=60,
+    # The same for the sorted titles /books/suggest looks prefixes up in.
+    SUGGEST_INDEX_PATH=os.environ.get('SUGGEST_INDEX_PATH'),
+    SUGGEST_INDEX_REFRESH_SECONDS=60,
+    # When the saved indexes are missing or older than this many seconds,
+    # the web processes build them themselves, so searches work without a
+    # scheduled `flask build-indexes` and a shared volume. With one that
+    # runs more often than this, they never do. None turns this off.
+    INDEX_MAX_AGE_SECONDS=3600,
 )
+Compress(app)
 
 app.debug = False
 app.testing = False
 
+# Record per-route and per-backend-call latencies, reported on /metrics and
+# in the Server-Timing header.
+metrics.init_app(app)
+
+# Reuse rendered pages and book list entries while the books are unchanged.
+caching.init_app(app)
+
+# Serve the JSON API alongside the HTML pages.
+app.register_blueprint(api.api, url_prefix='/api')
+
+# Index the books for /books/search and their titles for /books/suggest.
+search.init_app(app)
+suggest.init_app(app)
+
+
+def setup_cloud_logging():
+    """
+    Sends the logs to Stackdriver Logging. The client library is slow to
+    import and the handler looks up the environment it runs in, so this runs
+    in the background instead of delaying the first request. Until it's
+    done, logs go to stderr, which App Engine and Cloud Run also collect.
+    """
+    import google.cloud.logging
+    try:
+        client = google.cloud.logging.Client()
+        # Attaches a Google Stackdriver logging handler to the root logger
+        client.setup_logging()
+    except Exception:
+        logging.exception('Failed to set up Stackdriver Logging')
+
+
 # Configure logging
 if not app.testing:
     logging.basicConfig(level=logging.INFO)
-    client = google.cloud.logging.Client()
-    # Attaches a Google Stackdriver logging handler to the root logger
-    client.setup_logging()
+    thread = threading.Thread(target=setup_cloud_logging)
+    thread.daemon = True
+    thread.start()
 
 
 @app.route('/')
@@ -67,13 +147,157 @@ def list():
     start_after = request.args.get('start_after', None)
     books, last_title = firestore.next_page(start_after=start_after)
 
-    return render_template('list.html', books=books, last_title=last_title)
+    return caching.render_page(
+        render_template, 'list.html', app.config['LIST_CACHE_MAX_AGE'],
+        books=books, last_title=last_title)
+
+
+@app.route('/books/export')
+def export():
+    """
+    Streams every book as JSON lines. The response is compressed with gzip
+    when the client accepts it.
+
+    Anyone can download the export, so it only has the fields the API
+    returns, and no others that were stored with the book.
+    """
+    def generate():
+        fields = api.BOOK_FIELDS + ('version',)
+        for book in firestore.iterate(fields=fields):
+            yield json.dumps(book, sort_keys=True, default=str) + '\n'
+
+    def compress(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8'))
+            if data:
+                yield data
+        yield compressor.flush()
+
+    chunks = generate()
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if 'gzip' in request.accept_encodings:
+        chunks = compress(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype='application/x-ndjson',
+        headers=headers)
+
+
+@app.route('/books/search')
+def search_books():
+    query = request.args.get('q', '')
+    page = request.args.get('page', 1, type=int)
+    page = max(page, 1)
+    page_size = 10
+
+    index = search.get_index()
+    if not index.ready.is_set():
+        raise ServiceUnavailable(
+            'The search index is not loaded yet.', retry_after=10)
+    total, book_ids = index.search(
+        query, limit=page_size, offset=(page - 1) * page_size)
+    books = []
+    if book_ids:
+        # Skip books deleted by another process since the index was built.
+        books = [book for book in firestore.read_multi(book_ids) if book]
+
+    return render_template(
+        'search.html', query=query, books=books, total=total, page=page,
+        has_next=page * page_size < total)
+
+
+def save_indexes():
+    """
+    Builds the search index and the sorted titles for autocomplete from
+    every book in Firestore, in a single pass, and saves them where the web
+    processes load them from. Returns the number of books indexed.
+    """
+    titles = []
+
+    def books():
+        for book in firestore.iterate():
+            titles.append((book['id'], book.get('title')))
+            yield book
+
+    built_at = time.time()
+    index = search.build(search.index_path(app), books(), built_at)
+    suggest.save(suggest.index_path(app), titles, built_at)
+    return len(index)
+
+
+def rebuild_stale_indexes(max_age, interval):
+    """Saves new indexes whenever the saved ones are missing or older than
+    ``max_age`` seconds, checking every ``interval`` seconds."""
+    while True:
+        try:
+            age = time.time() - os.path.getmtime(search.index_path(app))
+        except OSError:
+            age = None
+        if age is None or age > max_age:
+            try:
+                logging.info('Indexed %d books', save_indexes())
+            except Exception:
+                logging.exception('Failed to build the indexes')
+        time.sleep(interval)
+
+
+_index_builder_lock = threading.Lock()
+
+
+@app.before_request
+def start_index_builder():
+    """
+    Starts rebuilding stale indexes in the background when the process
+    serves its first request, so that `flask build-indexes` and other
+    commands that import the app don't build them too.
+    """
+    max_age = app.config['INDEX_MAX_AGE_SECONDS']
+    if max_age is None or 'index_builder' in app.extensions:
+        return
+    with _index_builder_lock:
+        if 'index_builder' in app.extensions:
+            return
+        thread = threading.Thread(
+            target=rebuild_stale_indexes,
+            args=(max_age, app.config['SEARCH_INDEX_REFRESH_SECONDS']))
+        thread.daemon = True
+        app.extensions['index_builder'] = thread
+        thread.start()
+
+
+@app.cli.command('build-indexes')
+def build_indexes():
+    """
+    Builds the search index and the sorted titles for autocomplete, and
+    saves them where the web processes load them from. Run it on a
+    schedule, every few minutes, for example from cron or a Cloud Run job,
+    with SEARCH_INDEX_PATH and SUGGEST_INDEX_PATH on a volume the web
+    processes share.
+    """
+    print('Indexed {} books'.format(save_indexes()))
+
+
+@app.route('/books/suggest')
+def suggest_titles():
+    """Returns the books whose title starts with ``prefix``, as JSON, for
+    autocomplete."""
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    suggestions = suggest.get_index().suggest(
+        request.args.get('prefix', ''), limit=limit)
+    return flask.jsonify(suggestions=[
+        {'id': book_id, 'title': title} for book_id, title in suggestions])
 
 
 @app.route('/books/<book_id>')
 def view(book_id):
     book = firestore.read(book_id)
-    return render_template('view.html', book=book)
+    return caching.render_page(
+        render_template, 'view.html', app.config['VIEW_CACHE_MAX_AGE'],
+        book=book)
 
 
 @app.route('/books/add', methods=['GET', 'POST'])
@@ -100,6 +324,8 @@ def edit(book_id):
 
     if request.method == 'POST':
         data = request.form.to_dict(flat=True)
+        # The version of the book the form was filled in from.
+        version = data.pop('version', None)
 
         # If an image was uploaded, update the data to point to the new image.
         image_url = upload_image_file(request.files.get('image'))
@@ -107,7 +333,21 @@ def edit(book_id):
         if image_url:
             data['imageUrl'] = image_url
 
-        book = firestore.update(data, book_id)
+        if version and not version.isdigit():
+            raise BadRequest('version must be an integer')
+
+        try:
+            book = firestore.update(
+                data, book_id, version=int(version) if version else None)
+        except Conflict:
+            current = firestore.read(book_id)
+            if current is None:
+                return redirect(url_for('.list'))
+            # Show the form again with the user's changes, at the current
+            # version, so that saving it again replaces the other changes.
+            book = dict(current, **data)
+            return render_template(
+                'form.html', action='Edit', book=book, conflict=True), 409
 
         return redirect(url_for('.view', book_id=book['id']))
 
@@ -138,6 +378,9 @@ def errors():
 # is False
 @app.errorhandler(500)
 def server_error(e):
+    # Imported here as it's only needed when something went wrong, and is
+    # slow to import.
+    from google.cloud import error_reporting
     client = error_reporting.Client()
     client.report_exception(
         http_context=error_reporting.build_flask_context(request))
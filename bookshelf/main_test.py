@@ -12,14 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
 import re
+import time
 
 import google.auth
 import main
 import pytest
 import requests
 from six import BytesIO
+from werkzeug.exceptions import Conflict
 
 
 credentials, project_id = google.auth.default()
@@ -33,6 +36,8 @@ def app(request):
     It also ensures the tests run within a request context, allowing
     any calls to flask.request, flask.current_app, etc. to work."""
     app = main.app
+    # The tests build the indexes they need themselves.
+    app.config['INDEX_MAX_AGE_SECONDS'] = None
 
     with app.test_request_context():
         yield app
@@ -84,6 +89,371 @@ def test_list(app, firestore):
     assert 'More' in body, "Should have more than one page"
 
 
+def test_export(app, firestore):
+    for i in range(1, 12):
+        firestore.create({'title': u'Book {0}'.format(i),
+                          'createdBy': u'Someone'})
+
+    with app.test_client() as c:
+        rv = c.get('/books/export')
+
+    assert rv.status == '200 OK'
+    assert rv.mimetype == 'application/x-ndjson'
+    books = [json.loads(line)
+             for line in rv.data.decode('utf-8').splitlines()]
+    assert len(books) == 11
+    assert not any('createdBy' in book for book in books)
+
+
+def test_metrics(app, firestore, monkeypatch):
+    firestore.create({'title': u'Book 1'})
+
+    with app.test_client() as c:
+        rv = c.get('/')
+        assert 'firestore.next_page;dur=' in rv.headers['Server-Timing']
+        assert 'render_template;dur=' in rv.headers['Server-Timing']
+        assert 'total;dur=' in rv.headers['Server-Timing']
+
+        assert c.get('/metrics').status_code == 404
+        monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'token')
+        assert c.get('/metrics').status_code == 403
+        rv = c.get('/metrics', headers={'Authorization': 'Bearer wrong'})
+        assert rv.status_code == 403
+
+        rv = c.get('/metrics', headers={'Authorization': 'Bearer token'})
+
+    assert rv.status == '200 OK'
+    body = rv.data.decode('utf-8')
+    assert 'bookshelf_request_duration_seconds_count{route="/"}' in body
+    assert ('bookshelf_backend_call_duration_seconds_count'
+            '{route="/",call="firestore.next_page"}') in body
+
+
+def test_conditional_get(app, firestore):
+    book = firestore.create({'title': u'Book 1'})
+
+    with app.test_client() as c:
+        for path in ('/', '/books/{}'.format(book['id'])):
+            rv = c.get(path)
+            assert rv.status == '200 OK'
+            etag = rv.headers['ETag']
+            assert 'public' in rv.headers['Cache-Control']
+
+            rv = c.get(path, headers={'If-None-Match': etag})
+            assert rv.status == '304 NOT MODIFIED'
+            assert rv.data == b''
+            assert 'render_template' not in rv.headers['Server-Timing']
+
+        firestore.update({'title': u'Book 2'}, book['id'])
+        rv = c.get(
+            '/books/{}'.format(book['id']), headers={'If-None-Match': etag})
+
+    assert rv.status == '200 OK'
+    assert rv.headers['ETag'] != etag
+
+
+def test_compression(app, firestore):
+    for i in range(1, 12):
+        firestore.create({'title': u'Book {0}'.format(i)})
+
+    with app.test_client() as c:
+        rv = c.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in rv.headers['Vary']
+        etag = rv.headers['ETag']
+
+        # The ETag of the compressed page still validates it.
+        rv = c.get('/', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert rv.status == '304 NOT MODIFIED'
+        assert rv.headers['ETag'] == etag
+
+        rv = c.get('/')
+    assert 'Content-Encoding' not in rv.headers
+
+
+def test_render_cache(app, firestore):
+    book = firestore.create({'title': u'Book 1'})
+    view = '/books/{}'.format(book['id'])
+
+    with app.test_client() as c:
+        for path in ('/', view):
+            rv = c.get(path)
+            assert 'render_template' in rv.headers['Server-Timing']
+            rv = c.get(path)
+            assert 'render_template' not in rv.headers['Server-Timing']
+            assert 'Book 1' in rv.data.decode('utf-8')
+
+        fragments = app.extensions['fragment_cache']
+        assert fragments.get(book['id']) is not None
+
+        firestore.update({'title': u'Book 2'}, book['id'])
+        assert fragments.get(book['id']) is None
+
+        rv = c.get('/')
+        body = rv.data.decode('utf-8')
+        assert 'render_template' in rv.headers['Server-Timing']
+        assert 'Book 2' in body and 'Book 1' not in body
+
+        rv = c.get(view)
+        assert 'Book 2' in rv.data.decode('utf-8')
+
+
+def test_api(app, firestore):
+    with app.test_client() as c:
+        rv = c.post('/api/books', json={
+            'title': 'Test Book', 'author': 'Test Author',
+            'description': 'Test Description'})
+        assert rv.status_code == 201
+        book = rv.get_json()
+        assert rv.headers['Location'].endswith('/api/books/' + book['id'])
+
+        rv = c.get('/api/books/{}?fields=title'.format(book['id']))
+        assert rv.get_json() == {'id': book['id'], 'title': 'Test Book'}
+
+        rv = c.put('/api/books/{}'.format(book['id']), json={
+            'title': 'New Title', 'author': 'Test Author'})
+        assert rv.get_json()['title'] == 'New Title'
+
+        rv = c.get('/api/books/batch?ids={},missing&fields=author'.format(
+            book['id']))
+        assert rv.get_json() == {'books': [
+            {'id': book['id'], 'author': 'Test Author'}, None]}
+
+        rv = c.delete('/api/books/{}'.format(book['id']))
+        assert rv.status_code == 204
+        rv = c.get('/api/books/{}'.format(book['id']))
+        assert rv.status_code == 404
+        assert 'error' in rv.get_json()
+
+        # A PUT doesn't bring a deleted book back.
+        rv = c.put('/api/books/{}'.format(book['id']), json={
+            'title': 'New Title'})
+        assert rv.status_code == 404
+        assert firestore.read(book['id']) is None
+
+
+def test_versions(app, firestore):
+    book = firestore.create({'title': u'Book 1'})
+    assert book['version'] == 1
+
+    book = firestore.update({'title': u'Book 2'}, book['id'], version=1)
+    assert book['version'] == 2
+    with pytest.raises(Conflict):
+        firestore.update({'title': u'Book 3'}, book['id'], version=1)
+    assert firestore.read(book['id'])['title'] == u'Book 2'
+
+    with app.test_client() as c:
+        rv = c.put('/api/books/{}'.format(book['id']), json={
+            'title': 'Book 3', 'version': 1})
+        assert rv.status_code == 409
+
+        # The form was filled in before the book was changed.
+        rv = c.post('/books/{}/edit'.format(book['id']), data={
+            'title': u'Book 4', 'version': '1'})
+        assert rv.status_code == 409
+        assert 'value="2"' in rv.data.decode('utf-8')
+
+        rv = c.post('/books/{}/edit'.format(book['id']), data={
+            'title': u'Book 4', 'version': 'two'})
+        assert rv.status_code == 400
+
+        rv = c.post('/books/{}/edit'.format(book['id']), data={
+            'title': u'Book 4', 'version': '2'})
+        assert rv.status_code == 302
+
+    assert firestore.read(book['id'])['version'] == 3
+
+
+def test_update_replaces_book(app, firestore):
+    book = firestore.create({
+        'title': u'Book 1', 'author': u'Author', 'description': u'Old'})
+
+    # Only the title is written, and the description deleted.
+    firestore.update({'title': u'Book 2', 'author': u'Author'}, book['id'])
+
+    assert firestore.read(book['id']) == {
+        'id': book['id'], 'title': u'Book 2', 'author': u'Author',
+        'version': 2}
+
+    # A write with a version replaces the book the same way.
+    book = firestore.update({'title': u'Book 3'}, book['id'], version=2)
+    assert book == firestore.read(book['id']) == {
+        'id': book['id'], 'title': u'Book 3', 'version': 3}
+
+
+def test_api_list(app, firestore):
+    for i in range(1, 12):
+        firestore.create({'title': u'Book {0:02}'.format(i), 'author': 'A'})
+
+    with app.test_client() as c:
+        rv = c.get('/api/books?fields=author')
+        page = rv.get_json()
+        assert len(page['books']) == 10
+        assert set(page['books'][0]) == set(['id', 'author'])
+
+        rv = c.get('/api/books', query_string={
+            'cursor': page['next_cursor']})
+        page = rv.get_json()
+        assert [book['title'] for book in page['books']] == ['Book 11']
+        assert page['next_cursor'] is None
+
+        assert c.get('/api/books?fields=secret').status_code == 400
+        assert c.get('/api/books?limit=1000').status_code == 400
+        assert c.post('/api/books', json=['x']).status_code == 400
+
+
+def test_search(app, firestore, monkeypatch, tmpdir):
+    import search
+
+    # A process that hasn't loaded the index yet.
+    index = search.SearchIndex()
+    monkeypatch.setitem(app.extensions, 'search_index', index)
+    monkeypatch.setattr(firestore, '_write_listeners',
+                        firestore._write_listeners + [index.update])
+    monkeypatch.setitem(app.config, 'SEARCH_INDEX_PATH',
+                        str(tmpdir.join('index.json.gz')))
+
+    firestore.create({'title': u'Dune', 'author': u'Frank Herbert',
+                      'description': u'Spice and sandworms.'})
+    book = firestore.create({'title': u'Children of Dune',
+                             'author': u'Frank Herbert'})
+    for i in range(11):
+        firestore.create({'title': u'Sandworms {}'.format(i)})
+
+    with app.test_client() as c:
+        rv = c.get('/books/search?q=herbert')
+        assert rv.status_code == 503
+
+        result = app.test_cli_runner().invoke(args=['build-indexes'])
+        assert 'Indexed 13 books' in result.output
+        assert index.load(search.index_path(app))
+
+        rv = c.get('/books/search?q=herbert')
+        body = rv.data.decode('utf-8')
+        assert '2 books found' in body
+        assert 'Children of Dune' in body
+
+        rv = c.get('/books/search?q=sandworms')
+        body = rv.data.decode('utf-8')
+        assert '12 books found' in body
+        # The title match ranks above the description match.
+        assert 'Sandworms 0' in body and 'Spice' not in body
+        assert 'page=2' in body
+
+        firestore.update({'title': u'Messiah', 'author': u'Frank Herbert'},
+                         book['id'])
+        rv = c.get('/books/search?q=children+dune')
+        assert '0 books found' in rv.data.decode('utf-8')
+
+        firestore.delete(book['id'])
+        rv = c.get('/books/search?q=herbert')
+        assert '1 book found' in rv.data.decode('utf-8')
+
+
+def test_search_index(tmpdir):
+    import search
+
+    index = search.SearchIndex()
+    index.update('a', {'title': u'Caf\u00e9 Stories', 'author': u'Ann'})
+    index.update('b', {'title': u'Tales', 'description': u'cafe stories'})
+    assert index.search('cafe') == (2, ['a', 'b'])
+    assert index.search('cafe ann') == (1, ['a'])
+    assert index.search('cafe', limit=1, offset=1) == (2, ['b'])
+    assert index.search('') == (0, [])
+
+    path = str(tmpdir.join('index.json.gz'))
+    search.build(path, [{'id': 'a', 'title': u'Caf\u00e9 Stories'},
+                        {'id': 'b', 'description': u'cafe stories'}],
+                 time.time())
+    loaded = search.SearchIndex()
+    assert loaded.load(path)
+    assert loaded.search('stories') == index.search('stories')
+
+    index.update('a', None)
+    assert index.search('cafe') == (1, ['b'])
+    # Writes made since the saved index was built are kept when it loads.
+    assert index.load(path)
+    assert index.search('cafe') == (1, ['b'])
+    assert not search.SearchIndex().load(str(tmpdir.join('missing')))
+
+
+def test_search_index_keeps_recent_writes(monkeypatch, tmpdir):
+    import search
+
+    monkeypatch.setattr(search, 'MAX_WRITES', 2)
+    path = str(tmpdir.join('index.json.gz'))
+    search.build(path, [], time.time())
+
+    index = search.SearchIndex()
+    for book_id in 'abc':
+        index.update(book_id, {'title': u'Tales'})
+    # Only the last MAX_WRITES writes are applied again to a saved index.
+    assert index.load(path)
+    assert index.search('tales') == (2, ['b', 'c'])
+
+
+def test_suggest(app, firestore, monkeypatch, tmpdir):
+    import suggest
+
+    index = suggest.TitleIndex()
+    monkeypatch.setitem(app.extensions, 'title_index', index)
+    monkeypatch.setattr(firestore, '_write_listeners',
+                        firestore._write_listeners + [index.update])
+    monkeypatch.setitem(app.config, 'SEARCH_INDEX_PATH',
+                        str(tmpdir.join('index.json.gz')))
+    monkeypatch.setitem(app.config, 'SUGGEST_INDEX_PATH',
+                        str(tmpdir.join('titles')))
+
+    dune = firestore.create({'title': u'Dune'})
+    firestore.create({'title': u'The Hobbit'})
+    firestore.create({'title': u'Theory of Everything'})
+    app.test_cli_runner().invoke(args=['build-indexes'])
+    assert index.load(suggest.index_path(app))
+    assert len(index) == 3
+    # Written after the titles were saved.
+    messiah = firestore.create({'title': u'Dune Messiah'})
+
+    with app.test_client() as c:
+        rv = c.get('/books/suggest?prefix=DU')
+        assert rv.get_json() == {'suggestions': [
+            {'id': dune['id'], 'title': u'Dune'},
+            {'id': messiah['id'], 'title': u'Dune Messiah'}]}
+
+        rv = c.get('/books/suggest', query_string={'prefix': 'the '})
+        titles = [s['title'] for s in rv.get_json()['suggestions']]
+        assert titles == [u'The Hobbit']
+
+        firestore.update({'title': u'Arrakis'}, dune['id'])
+        rv = c.get('/books/suggest?prefix=du&limit=5')
+        titles = [s['title'] for s in rv.get_json()['suggestions']]
+        assert titles == [u'Dune Messiah']
+
+        firestore.delete(dune['id'])
+        rv = c.get('/books/suggest?prefix=ar')
+        assert rv.get_json() == {'suggestions': []}
+
+
+def test_title_index_writes(monkeypatch):
+    import search
+    import suggest
+
+    monkeypatch.setattr(search, 'MAX_WRITES', 2)
+    index = suggest.TitleIndex()
+    index.update('a', {'title': u'Dune'})
+    # A write without a title field leaves the suggestion alone.
+    index.update('a', {'author': u'Frank Herbert'})
+    assert index.suggest('du') == [('a', u'Dune')]
+
+    index.update('b', {'title': u'Dune Messiah'})
+    index.update('c', {'title': u'Children of Dune'})
+    # Only the last MAX_WRITES writes are kept.
+    assert index.suggest('du') == [('b', u'Dune Messiah')]
+
+    index.update('b', None)
+    assert index.suggest('du') == []
+
+
 def test_add(app):
     data = {
         'title': 'Test Book',
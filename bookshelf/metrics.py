@@ -0,0 +1,182 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request latency metrics. Records how long each route takes and how long it
+spends in each instrumented backend call, exposes the histograms in the
+Prometheus text format on /metrics to requests that send the METRICS_TOKEN,
+and adds a Server-Timing header to every response.
+
+Metrics are kept in memory per process, so each worker process reports its
+own numbers.
+"""
+
+import bisect
+import functools
+import hmac
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request, Response
+from werkzeug.exceptions import Forbidden, NotFound
+
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+_lock = threading.Lock()
+# Keyed by route.
+_request_durations = {}
+# Keyed by (route, call).
+_call_durations = {}
+
+
+def _observe(histograms, key, seconds):
+    with _lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def _route():
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
+def timed(name):
+    """
+    Decorator that records the duration of every call to the decorated
+    function under ``name``.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _record_call(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _record_call(name, seconds):
+    # Calls made outside of a request, such as from tests or scripts, are
+    # recorded without a route.
+    route = ''
+    if has_request_context():
+        route = _route()
+        g.setdefault('call_timings', []).append((name, seconds))
+    _observe(_call_durations, (route, name), seconds)
+
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+def _record_request(response):
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+    seconds = time.perf_counter() - start
+    _observe(_request_durations, _route(), seconds)
+
+    # Sum repeated calls, so that a route calling firestore.read twice
+    # reports one entry for it.
+    totals = {}
+    for name, call_seconds in g.pop('call_timings', []):
+        totals[name] = totals.get(name, 0.0) + call_seconds
+    entries = ['{};dur={:.1f}'.format(name, call_seconds * 1000)
+               for name, call_seconds in sorted(totals.items())]
+    entries.append('total;dur={:.1f}'.format(seconds * 1000))
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+            name, labels, bound, cumulative))
+    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.sum))
+    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        lines.append('# HELP bookshelf_request_duration_seconds '
+                     'Time spent handling requests.')
+        lines.append('# TYPE bookshelf_request_duration_seconds histogram')
+        for route, histogram in sorted(_request_durations.items()):
+            _format_histogram(
+                lines, 'bookshelf_request_duration_seconds',
+                'route="{}"'.format(_escape(route)), histogram)
+
+        lines.append('# HELP bookshelf_backend_call_duration_seconds '
+                     'Time spent in backend calls and template rendering.')
+        lines.append('# TYPE bookshelf_backend_call_duration_seconds '
+                     'histogram')
+        for (route, call), histogram in sorted(_call_durations.items()):
+            _format_histogram(
+                lines, 'bookshelf_backend_call_duration_seconds',
+                'route="{}",call="{}"'.format(_escape(route), _escape(call)),
+                histogram)
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics():
+    """Requires an ``Authorization: Bearer <METRICS_TOKEN>`` header. Without
+    a METRICS_TOKEN configured, the metrics aren't served."""
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        raise NotFound()
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(header.encode('utf-8'),
+                               'Bearer {}'.format(token).encode('utf-8')):
+        raise Forbidden()
+
+    return Response(
+        render_metrics(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Times every request to app and serves the metrics on /metrics."""
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    app.add_url_rule('/metrics', 'metrics', _metrics)
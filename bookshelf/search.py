@@ -0,0 +1,256 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Full-text search over the titles, authors and descriptions of the books.
+
+The index is built from Firestore by the ``flask build-indexes`` command,
+which runs on a schedule rather than in the web processes, and saved to
+SEARCH_INDEX_PATH. When no scheduled build keeps it newer than
+INDEX_MAX_AGE_SECONDS, the web processes build it themselves. Each web
+process keeps the saved index in memory and loads it again when the file
+changes, checking every SEARCH_INDEX_REFRESH_SECONDS. Writes made through
+firestore.py update it straight away, and are applied again on top of any
+saved index built before them.
+"""
+
+import collections
+import gzip
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+
+import firestore
+from flask import current_app
+
+
+# How much a term counts in each field.
+FIELD_WEIGHTS = (('title', 3.0), ('author', 2.0), ('description', 1.0))
+
+_FORMAT_VERSION = 2
+
+# How many of its own writes a process keeps to apply again on top of a
+# saved index built before them. Older ones are dropped, and only show up
+# once a saved index that includes them is loaded.
+MAX_WRITES = 10000
+
+
+def fold(text):
+    """Returns text in lowercase with accents removed, so that "Café" and
+    "cafe" compare equal."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Splits text into lowercase terms, with accents removed."""
+    return re.findall(r'\w+', fold(text))
+
+
+def book_terms(book):
+    """Returns a dict of the terms in a book to their weight."""
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        value = book.get(field)
+        if isinstance(value, str):
+            for term in tokenize(value):
+                terms[term] = terms.get(term, 0.0) + weight
+    return terms
+
+
+class SearchIndex(object):
+    """
+    An inverted index from terms to the ids of the books containing them.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Book id to {term: weight}.
+        self._books = {}
+        # Term to {book id: weight}.
+        self._postings = {}
+        # When the books in the index were read from Firestore.
+        self.built_at = None
+        # Writes made by this process since then, as (time, book id, terms),
+        # to apply again to a saved index built before them.
+        self._writes = collections.deque(maxlen=MAX_WRITES)
+        self.ready = threading.Event()
+
+    def __len__(self):
+        return len(self._books)
+
+    def _add(self, book_id, terms):
+        self._books[book_id] = terms
+        for term, weight in terms.items():
+            self._postings.setdefault(term, {})[book_id] = weight
+
+    def _remove(self, book_id):
+        for term in self._books.pop(book_id, {}):
+            postings = self._postings[term]
+            del postings[book_id]
+            if not postings:
+                del self._postings[term]
+
+    def update(self, book_id, book):
+        """Indexes ``book``, replacing any previous version. A ``book`` of
+        None removes it."""
+        terms = book_terms(book) if book is not None else None
+        with self._lock:
+            self._remove(book_id)
+            if terms:
+                self._add(book_id, terms)
+            self._writes.append((time.time(), book_id, terms))
+
+    def _replace(self, books, built_at):
+        """Replaces the contents of the index with ``books``, a dict of book
+        ids to their terms read from Firestore at ``built_at``, and applies
+        the writes made since then again."""
+        with self._lock:
+            self._writes = collections.deque(
+                (write for write in self._writes if write[0] >= built_at),
+                maxlen=MAX_WRITES)
+            self._books = {}
+            self._postings = {}
+            for book_id, terms in books.items():
+                self._add(book_id, terms)
+            for _, book_id, terms in self._writes:
+                self._remove(book_id)
+                if terms:
+                    self._add(book_id, terms)
+            self.built_at = built_at
+        self.ready.set()
+
+    def rebuild(self, books, built_at):
+        """Replaces the contents of the index with ``books``, an iterable
+        of books that started to be read from Firestore at ``built_at``."""
+        self._replace(
+            dict((book['id'], book_terms(book)) for book in books), built_at)
+
+    def search(self, query, limit=10, offset=0):
+        """
+        Returns the number of books matching every term in ``query``, and
+        the ids of ``limit`` of them from ``offset``, best matches first.
+        Matches are ranked by the weight of the terms in the book, times how
+        rare the terms are.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return 0, []
+
+        with self._lock:
+            postings = [self._postings.get(term, {}) for term in terms]
+            postings.sort(key=len)
+            if not postings[0]:
+                return 0, []
+            matches = set(postings[0])
+            for other in postings[1:]:
+                matches.intersection_update(other)
+
+            total = float(len(self._books))
+            scores = dict((book_id, 0.0) for book_id in matches)
+            for term_postings in postings:
+                idf = math.log(1 + total / len(term_postings))
+                for book_id in matches:
+                    scores[book_id] += term_postings[book_id] * idf
+
+        ranked = sorted(scores, key=lambda book_id: (-scores[book_id],
+                                                     book_id))
+        return len(ranked), ranked[offset:offset + limit]
+
+    def save(self, path):
+        """Writes the index to ``path``, replacing it atomically."""
+        with self._lock:
+            data = json.dumps({'version': _FORMAT_VERSION,
+                               'built_at': self.built_at,
+                               'books': self._books})
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(data.encode('utf-8'))
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Replaces the contents of the index with those saved at ``path``.
+        Returns False if there is no usable saved index."""
+        try:
+            with gzip.open(path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return False
+        if data.get('version') != _FORMAT_VERSION:
+            return False
+        self._replace(data['books'], data['built_at'])
+        return True
+
+
+def get_index():
+    return current_app.extensions['search_index']
+
+
+def index_path(app):
+    return app.config['SEARCH_INDEX_PATH'] or os.path.join(
+        tempfile.gettempdir(), 'bookshelf-search-index.json.gz')
+
+
+def build(path, books, built_at):
+    """Indexes ``books``, an iterable of every book that started to be read
+    from Firestore at ``built_at``, and saves the index to ``path``."""
+    index = SearchIndex()
+    index.rebuild(books, built_at)
+    index.save(path)
+    return index
+
+
+def watch(name, index, path, interval):
+    """Loads the saved index at ``path`` with ``index.load``, and loads it
+    again whenever it changes."""
+    loaded = None
+    while True:
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            modified = None
+        if modified is not None and modified != loaded:
+            if index.load(path):
+                loaded = modified
+                logging.info('Loaded the %s of %d books', name, len(index))
+            else:
+                logging.error('Failed to load the %s at %s', name, path)
+        time.sleep(interval)
+
+
+def init_app(app):
+    """
+    Sets up the search index for app and starts loading the saved index in
+    the background. Searches fail with 503 Service Unavailable until it is
+    loaded.
+    """
+    index = SearchIndex()
+    app.extensions['search_index'] = index
+    firestore.add_write_listener(index.update)
+
+    thread = threading.Thread(
+        target=watch,
+        args=('search index', index, index_path(app),
+              app.config['SEARCH_INDEX_REFRESH_SECONDS']))
+    thread.daemon = True
+    thread.start()
@@ -18,7 +18,7 @@ import datetime
 import os
 
 from flask import current_app
-from google.cloud import storage
+import metrics
 import six
 from werkzeug.exceptions import BadRequest
 from werkzeug.utils import secure_filename
@@ -44,6 +44,7 @@ def _safe_filename(filename):
     return "{0}-{1}.{2}".format(basename, date, extension)
 
 
+@metrics.timed('storage.upload_file')
 def upload_file(file_stream, filename, content_type):
     """
     Uploads a file to a given Cloud Storage bucket and returns the public url
@@ -55,6 +56,9 @@ def upload_file(file_stream, filename, content_type):
     bucketname = os.getenv('GOOGLE_STORAGE_BUCKET') or os.getenv(
         'GOOGLE_CLOUD_PROJECT') + '_bucket'
 
+    # Imported here as only uploads need it, and it is slow to import.
+    from google.cloud import storage
+
     # [START bookshelf_cloud_storage_client]
     client = storage.Client()
     bucket = client.bucket(bucketname)
@@ -0,0 +1,244 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Title autocomplete.
+
+The titles of the books are saved sorted to a file by the ``flask
+build-indexes`` command, in the same pass over Firestore that builds the
+search index, so the titles starting with a prefix are next to each other
+and found by binary search. Each entry is a single string, "<folded
+title>\\0<title>\\0<id>".
+
+Web processes memory-map the file rather than reading it, so the processes
+on a machine share a single copy of it in the page cache instead of each
+keeping about 150 MB for a million titles, see benchmarks/suggest_index.py.
+They map it again when it changes, checking every
+SUGGEST_INDEX_REFRESH_SECONDS. Like the search index, writes made through
+firestore.py are seen straight away, and are applied on top of any saved
+titles read before them.
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import firestore
+from flask import current_app
+import search
+
+
+_SEPARATOR = u'\0'
+
+# The file starts with _HEADER: _MAGIC, when the titles were read from
+# Firestore and the number of entries. Then come the offsets of the entries
+# and of their end, as unsigned 64-bit integers, and the entries themselves
+# in UTF-8. UTF-8 sorts like the strings it encodes, so the entries can be
+# compared as bytes.
+_MAGIC = b'BKTITLE1'
+_HEADER = struct.Struct('<8sdQ')
+_OFFSET = struct.Struct('<Q')
+
+
+def _normalize(title):
+    """Returns the form of title prefixes are matched against: folded, with
+    runs of whitespace collapsed."""
+    return u' '.join(search.fold(title.replace(_SEPARATOR, u' ')).split())
+
+
+def _entry(book_id, title):
+    return _SEPARATOR.join((_normalize(title), title, book_id))
+
+
+def _parse(entry):
+    """Returns the (id, title) of an entry."""
+    title, book_id = entry.split(_SEPARATOR, 1)[1].rsplit(_SEPARATOR, 1)
+    return book_id, title
+
+
+def save(path, titles, built_at):
+    """Writes ``titles``, (id, title) pairs read from Firestore at
+    ``built_at``, to ``path``, replacing it atomically."""
+    entries = sorted(_entry(book_id, title).encode('utf-8')
+                     for book_id, title in titles if title)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, built_at, len(entries)))
+        offset = 0
+        for entry in entries:
+            f.write(_OFFSET.pack(offset))
+            offset += len(entry)
+        f.write(_OFFSET.pack(offset))
+        for entry in entries:
+            f.write(entry)
+    os.replace(tmp_path, path)
+
+
+class SavedTitles(object):
+    """The entries saved at a path, read from a memory map."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.built_at, self._count = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC:
+            raise ValueError('{} is not a title index'.format(path))
+        self._entries_start = (
+            _HEADER.size + _OFFSET.size * (self._count + 1))
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        start, = _OFFSET.unpack_from(
+            self._map, _HEADER.size + _OFFSET.size * i)
+        end, = _OFFSET.unpack_from(
+            self._map, _HEADER.size + _OFFSET.size * (i + 1))
+        return self._map[self._entries_start + start:
+                         self._entries_start + end]
+
+    def starting_with(self, prefix):
+        """Yields the entries starting with ``prefix``, in order."""
+        prefix = prefix.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle) < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        for i in range(low, self._count):
+            entry = self._entry(i)
+            if not entry.startswith(prefix):
+                return
+            yield entry.decode('utf-8')
+
+
+class TitleIndex(object):
+    """The saved titles of the books, and the titles written by this process
+    since they were read. Safe to use from several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._saved = None
+        # Book id to the time and entry of its last write by this process,
+        # with an entry of None for books deleted or left without a title,
+        # oldest first and at most search.MAX_WRITES of them.
+        self._writes = {}
+        # The entries of _writes that aren't None, sorted.
+        self._written = []
+        self.ready = threading.Event()
+
+    def __len__(self):
+        return len(self._saved) if self._saved is not None else 0
+
+    def _forget(self, book_id):
+        _, entry = self._writes.pop(book_id, (None, None))
+        if entry is not None:
+            del self._written[bisect.bisect_left(self._written, entry)]
+
+    def update(self, book_id, book):
+        """Indexes the title of ``book``, replacing any previous one. A
+        ``book`` of None, or with an empty title, removes it, and one
+        without a title field leaves it as it is."""
+        if book is not None and 'title' not in book:
+            return
+        title = book['title'] if book is not None else None
+        entry = _entry(book_id, title) if title else None
+        with self._lock:
+            # Re-adding the book keeps _writes in the order of the writes,
+            # so the oldest ones are dropped first.
+            self._forget(book_id)
+            self._writes[book_id] = (time.time(), entry)
+            if entry is not None:
+                bisect.insort(self._written, entry)
+            while len(self._writes) > search.MAX_WRITES:
+                self._forget(next(iter(self._writes)))
+
+    def load(self, path):
+        """Replaces the saved titles with those at ``path``. Returns False
+        if there are no usable saved titles."""
+        try:
+            saved = SavedTitles(path)
+        except (IOError, OSError, ValueError, struct.error):
+            return False
+        with self._lock:
+            self._saved = saved
+            self._writes = dict(
+                (book_id, write) for book_id, write in self._writes.items()
+                if write[0] >= saved.built_at)
+            self._written = sorted(
+                entry for _, entry in self._writes.values()
+                if entry is not None)
+        self.ready.set()
+        return True
+
+    def suggest(self, prefix, limit=10):
+        """Returns up to ``limit`` (id, title) pairs of the books whose title
+        starts with ``prefix``, ignoring case and accents, in title order."""
+        normalized = _normalize(prefix)
+        if not normalized:
+            return []
+        # "the " should match "The Hobbit" but not "Theory".
+        if prefix[-1].isspace():
+            normalized += u' '
+        prefix = normalized
+
+        entries = []
+        with self._lock:
+            i = bisect.bisect_left(self._written, prefix)
+            for entry in self._written[i:i + limit]:
+                if entry.startswith(prefix):
+                    entries.append(entry)
+            # Saved entries of the books written since are replaced by the
+            # written ones.
+            if self._saved is not None:
+                saved = []
+                for entry in self._saved.starting_with(prefix):
+                    if len(saved) == limit:
+                        break
+                    if _parse(entry)[0] not in self._writes:
+                        saved.append(entry)
+                entries = sorted(entries + saved)
+        return [_parse(entry) for entry in entries[:limit]]
+
+
+def get_index():
+    return current_app.extensions['title_index']
+
+
+def index_path(app):
+    return app.config['SUGGEST_INDEX_PATH'] or os.path.join(
+        tempfile.gettempdir(), 'bookshelf-titles')
+
+
+def init_app(app):
+    """Sets up the title index for app and starts mapping the saved titles
+    in the background. Until they are, only the titles written by this
+    process are suggested."""
+    index = TitleIndex()
+    app.extensions['title_index'] = index
+    firestore.add_write_listener(index.update)
+
+    thread = threading.Thread(
+        target=search.watch,
+        args=('title index', index, index_path(app),
+              app.config['SUGGEST_INDEX_REFRESH_SECONDS']))
+    thread.daemon = True
+    thread.start()
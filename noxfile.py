@@ -10,6 +10,7 @@ DIRS = [
     'authenticating-users',
     'background/app',
     'background/function',
+    'benchmarks',
     'gce',
     'sessions',
     'bookshelf',
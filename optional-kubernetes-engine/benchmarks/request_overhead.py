@@ -0,0 +1,110 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the per-request overhead of resolving the data model and creating a
+Datastore client, with and without the per-app model and the shared client.
+
+Run it against the Datastore emulator from the optional-kubernetes-engine
+directory:
+
+    $ gcloud beta emulators datastore start --no-store-on-disk &
+    $ $(gcloud beta emulators datastore env-init)
+    $ PYTHONPATH=. python benchmarks/request_overhead.py
+"""
+
+import argparse
+import timeit
+
+import bookshelf
+from bookshelf import model_datastore
+import config
+from flask import current_app
+from google.cloud import datastore
+
+
+def _per_call_client():
+    """The previous behavior: a new client for every model call."""
+    return datastore.Client(current_app.config['PROJECT_ID'])
+
+
+def _report(name, before, after, number):
+    print("{:<24} {:>10.1f} us {:>10.1f} us {:>9.1f}x".format(
+        name, before / number * 1e6, after / number * 1e6,
+        before / after if after else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=200)
+    args = parser.parse_args()
+
+    app = bookshelf.create_app(
+        config, testing=True, config_overrides={'DATA_BACKEND': 'datastore'})
+    model = app.extensions['bookshelf_model']
+    client = app.test_client()
+
+    with app.app_context():
+        book = model.create({'title': 'Benchmark Book'})
+
+    def request_list():
+        client.get('/books/')
+
+    def request_view():
+        client.get('/books/{}'.format(book['id']))
+
+    print("{:<24} {:>13} {:>13} {:>10}".format(
+        '', 'before', 'after', 'speedup'))
+
+    try:
+        with app.app_context():
+            # Resolving the model from the config is what every call to
+            # get_model() did before the model was kept on the app.
+            _report(
+                'get_model()',
+                timeit.timeit(
+                    lambda: bookshelf.get_model(
+                        current_app.config['DATA_BACKEND']),
+                    number=args.number * 10),
+                timeit.timeit(bookshelf.get_model, number=args.number * 10),
+                args.number * 10)
+            _report(
+                'get_client()',
+                timeit.timeit(_per_call_client, number=args.number),
+                timeit.timeit(model_datastore.get_client, number=args.number),
+                args.number)
+
+        # Warm up the shared client before timing the requests.
+        request_list()
+
+        get_client = model_datastore.get_client
+        model_datastore.get_client = _per_call_client
+        app.extensions.pop('bookshelf_model')
+        before_list = timeit.timeit(request_list, number=args.number)
+        before_view = timeit.timeit(request_view, number=args.number)
+
+        model_datastore.get_client = get_client
+        app.extensions['bookshelf_model'] = model
+        after_list = timeit.timeit(request_list, number=args.number)
+        after_view = timeit.timeit(request_view, number=args.number)
+
+        _report('GET /books/', before_list, after_list, args.number)
+        _report('GET /books/<id>', before_view, after_view, args.number)
+    finally:
+        with app.app_context():
+            model.delete(book['id'])
+
+
+if __name__ == '__main__':
+    main()
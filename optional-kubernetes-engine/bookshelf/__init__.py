@@ -37,10 +37,12 @@ def create_app(config, debug=False, testing=False, config_overrides=None):
     if not app.testing:
         logging.basicConfig(level=logging.INFO)
 
-    # Setup the data model.
+    # Setup the data model. The model is resolved once and kept on the app,
+    # so requests don't have to look it up again.
     with app.app_context():
-        model = get_model()
+        model = get_model(app.config['DATA_BACKEND'])
         model.init_app(app)
+    app.extensions['bookshelf_model'] = model
 
     # Create a health check handler. Health checks are used when running on
     # Google Compute Engine by the load balancer to determine which instances
@@ -50,6 +52,12 @@ def create_app(config, debug=False, testing=False, config_overrides=None):
     def health_check():
         return 'ok', 200
 
+    # Register the on-demand profiler when a token is configured, see
+    # profiling.py. Without one, the endpoint doesn't exist.
+    if app.config.get('PROFILING_TOKEN'):
+        from . import profiling
+        app.add_url_rule('/_ah/profile', 'profile', profiling.profile)
+
     # Initalize the OAuth2 helper.
     oauth2.init_app(
         app,
@@ -87,15 +95,25 @@ def create_app(config, debug=False, testing=False, config_overrides=None):
     return app
 
 
-def get_model():
-    model_backend = current_app.config['DATA_BACKEND']
-    if model_backend == 'cloudsql':
+def get_model(backend=None):
+    """
+    Returns the data model module for ``backend``. Without a backend, returns
+    the app's model, which is resolved from ``DATA_BACKEND`` in
+    ``create_app``.
+    """
+    if backend is None:
+        model = current_app.extensions.get('bookshelf_model')
+        if model is not None:
+            return model
+        backend = current_app.config['DATA_BACKEND']
+
+    if backend == 'cloudsql':
         from . import model_cloudsql
         model = model_cloudsql
-    elif model_backend == 'datastore':
+    elif backend == 'datastore':
         from . import model_datastore
         model = model_datastore
-    elif model_backend == 'mongodb':
+    elif backend == 'mongodb':
         from . import model_mongodb
         model = model_mongodb
     else:
@@ -0,0 +1,315 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Helpers for moving large numbers of books in and out of the data model
+without going through the web application one book at a time.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import time
+import zlib
+
+
+def _open_text(path, mode):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def read_books(path):
+    """
+    Streams books from a JSON lines file (one book per line) or a CSV file
+    with a header row. Files ending in ``.gz`` are decompressed on the fly.
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+
+    with _open_text(path, 'r') as f:
+        if name.endswith('.csv'):
+            for row in csv.DictReader(f):
+                # Empty CSV cells are treated as missing fields.
+                yield dict((k, v) for k, v in row.items() if v != '')
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def iter_jsonl(books):
+    """Yields each book as a line of JSON."""
+    for book in books:
+        yield json.dumps(book, sort_keys=True, default=str) + '\n'
+
+
+def gzip_stream(chunks):
+    """Compresses a stream of text chunks, yielding gzip data as it becomes
+    available."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_books(books, path):
+    """
+    Writes books to a JSON lines file, compressing it if the path ends in
+    ``.gz``. Returns the number of books written.
+    """
+    count = 0
+    with _open_text(path, 'w') as f:
+        for line in iter_jsonl(books):
+            f.write(line)
+            count += 1
+    return count
+
+
+def batched(iterable, size):
+    """Yields lists of up to ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _write_batches(app, write, batches, workers=4, report_interval=10,
+                   on_done=None):
+    """
+    Calls ``write(batch)`` for each batch from a pool of ``workers`` threads,
+    each with its own app context. Only a few batches are read ahead so memory
+    use stays bounded regardless of the input size. ``on_done(batch, result)``
+    is called from the calling thread as batches finish. Progress is logged
+    every ``report_interval`` seconds.
+
+    Returns the number of items written and the elapsed time in seconds.
+    """
+    def run(batch):
+        with app.app_context():
+            return batch, write(batch)
+
+    start = last_report = time.time()
+    count = 0
+    pending = set()
+
+    def finish(futures):
+        written = 0
+        for future in futures:
+            batch, result = future.result()
+            if on_done:
+                on_done(batch, result)
+            written += len(batch)
+        return written
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batches:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                count += finish(done)
+
+                now = time.time()
+                if now - last_report >= report_interval:
+                    last_report = now
+                    logging.info("Wrote %d books (%.0f books/sec)",
+                                 count, count / (now - start))
+
+            pending.add(executor.submit(run, batch))
+
+        count += finish(wait(pending).done)
+
+    return count, time.time() - start
+
+
+def import_books(app, model, books, batch_size=500, workers=4,
+                 report_interval=10):
+    """
+    Writes ``books`` to ``model`` in batches using ``model.create_multi``,
+    with up to ``workers`` batches written in parallel.
+
+    Returns the number of books written and the elapsed time in seconds.
+    """
+    return _write_batches(
+        app, model.create_multi, batched(books, batch_size),
+        workers=workers, report_interval=report_interval)
+
+
+def _read_checkpoint(path):
+    id_map = {}
+    pending = set()
+    if not os.path.exists(path):
+        return id_map, pending
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if 'pending' in entry:
+                pending.update(entry['pending'])
+            else:
+                id_map[entry['source']] = entry['target']
+    return id_map, pending - set(id_map)
+
+
+def read_checkpoint(path):
+    """
+    Reads the id mapping written by :func:`migrate_books`. Returns a dict of
+    source ids to target ids, both as strings.
+    """
+    return _read_checkpoint(path)[0]
+
+
+def _recover_pending(source, target, id_map, pending, batch_size):
+    """
+    Finds the target books written by batches that were started but never
+    recorded, matching them to their source books by content. Returns a
+    dict of source ids to target ids for the books that were found.
+    """
+    copied = set(id_map.values())
+    unmapped = {}
+    for book in target.iterate(batch_size=batch_size):
+        if str(book['id']) not in copied:
+            unmapped.setdefault(_book_hash(book), []).append(str(book['id']))
+
+    recovered = {}
+    for book in source.iterate(batch_size=batch_size):
+        if str(book['id']) in pending:
+            matches = unmapped.get(_book_hash(book))
+            if matches:
+                recovered[str(book['id'])] = matches.pop()
+    return recovered
+
+
+def migrate_books(app, source, target, checkpoint_path, batch_size=500,
+                  workers=4, report_interval=10):
+    """
+    Copies every book from the ``source`` model to the ``target`` model.
+
+    Books get new ids in the target, since the backends use incompatible id
+    types. Before a batch is written its source ids are appended to the
+    checkpoint file as pending, and once it finishes its source to target id
+    mapping is appended, so the file doubles as the id map for redirecting
+    old URLs. Running the migration again with the same checkpoint skips
+    books that were already copied, so an interrupted migration can be
+    resumed and a final run picks up books created since the last one.
+    Books from batches that were pending when the migration stopped are
+    looked up in the target by content and only copied if they aren't
+    there. Edits to books that were already copied are not picked up.
+
+    Must be called within an app context with both models initialized.
+    Returns the number of books copied and the elapsed time in seconds.
+    """
+    if source is target:
+        raise ValueError("Can't migrate books to the model they come from.")
+
+    id_map, pending = _read_checkpoint(checkpoint_path)
+    if id_map:
+        logging.info("Resuming, %d books already copied", len(id_map))
+
+    with io.open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        def record(batch, ids):
+            for book, new_id in zip(batch, ids):
+                checkpoint.write(json.dumps(
+                    {'source': str(book['id']), 'target': str(new_id)}) +
+                    u'\n')
+            checkpoint.flush()
+
+        if pending:
+            recovered = _recover_pending(
+                source, target, id_map, pending, batch_size)
+            logging.info("Found %d of %d books from unfinished batches",
+                         len(recovered), len(pending))
+            record([{'id': book_id} for book_id in recovered],
+                   list(recovered.values()))
+            id_map.update(recovered)
+
+        books = (book for book in source.iterate(batch_size=batch_size)
+                 if str(book['id']) not in id_map)
+
+        def announce(batches):
+            # Runs in the calling thread as each batch is handed to a worker.
+            for batch in batches:
+                checkpoint.write(json.dumps(
+                    {'pending': [str(book['id']) for book in batch]}) +
+                    u'\n')
+                checkpoint.flush()
+                yield batch
+
+        def write(batch):
+            return target.create_multi(batch, return_ids=True)
+
+        return _write_batches(
+            app, write, announce(batched(books, batch_size)),
+            workers=workers, report_interval=report_interval,
+            on_done=record)
+
+
+# Fields compared when verifying a migration. Ids differ between backends,
+# and backends differ in how they store missing fields, so only these fields
+# with non-empty values are compared.
+BOOK_FIELDS = (
+    'title', 'author', 'publishedDate', 'imageUrl', 'description',
+    'createdBy', 'createdById')
+
+
+def _book_hash(book):
+    fields = dict((name, book[name]) for name in BOOK_FIELDS
+                  if book.get(name) not in (None, ''))
+    digest = hashlib.sha1(
+        json.dumps(fields, sort_keys=True, default=str).encode('utf-8'))
+    return int(digest.hexdigest()[:16], 16)
+
+
+def checksum_books(books):
+    """
+    Returns the number of books and an order independent checksum of their
+    contents, ignoring ids.
+    """
+    count = 0
+    checksum = 0
+    for book in books:
+        count += 1
+        checksum = (checksum + _book_hash(book)) % (1 << 64)
+    return count, checksum
+
+
+def verify_migration(source, target, batch_size=1000):
+    """
+    Compares the number of books and content checksums of two models. Must be
+    called within an app context with both models initialized. Returns a
+    dict with the counts and checksums of both sides and whether they match.
+    """
+    source_count, source_checksum = checksum_books(
+        source.iterate(batch_size=batch_size))
+    target_count, target_checksum = checksum_books(
+        target.iterate(batch_size=batch_size))
+    return {
+        'source_count': source_count,
+        'source_checksum': '{:016x}'.format(source_checksum),
+        'target_count': target_count,
+        'target_checksum': '{:016x}'.format(target_checksum),
+        'ok': (source_count == target_count and
+               source_checksum == target_checksum),
+    }
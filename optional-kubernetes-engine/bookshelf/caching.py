@@ -0,0 +1,69 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP caching for the book pages. Each page gets an ETag computed from its
+template and the data it shows, so a browser or CDN revalidating a page that
+hasn't changed gets a 304 Not Modified without the template being rendered.
+"""
+
+import hashlib
+import json
+
+from flask import current_app, request
+
+
+def _template_digest(template):
+    """Returns a digest of the template's source and of base.html, so that
+    ETags change when the templates are deployed."""
+    digests = current_app.extensions.setdefault('template_digests', {})
+    digest = digests.get(template)
+    if digest is None:
+        env = current_app.jinja_env
+        sha = hashlib.sha1()
+        for name in (template, 'base.html'):
+            sha.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        digest = digests[template] = sha.hexdigest()
+    return digest
+
+
+def page_etag(template, context):
+    """Returns the ETag of ``template`` rendered with ``context``."""
+    sha = hashlib.sha1(_template_digest(template).encode('utf-8'))
+    sha.update(json.dumps(context, sort_keys=True, default=str).encode(
+        'utf-8'))
+    return sha.hexdigest()
+
+
+def render_page(render, template, max_age, **context):
+    """
+    Returns the response for ``template`` rendered with ``context`` by
+    ``render``, with an ETag and a Cache-Control header allowing caches to
+    keep it for ``max_age`` seconds. With a ``max_age`` of 0, caches must
+    revalidate the page on every request. If the request's If-None-Match
+    header matches, returns 304 Not Modified without rendering the template.
+    """
+    etag = page_etag(template, context)
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(render(template, **context))
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
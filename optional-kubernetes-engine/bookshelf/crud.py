@@ -12,9 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from bookshelf import get_model, oauth2, storage, tasks
+from bookshelf import caching, get_model, listings, oauth2, storage, tasks
 from flask import Blueprint, current_app, redirect, render_template, request, \
-    session, url_for
+    Response, session, stream_with_context, url_for
+from werkzeug.exceptions import BadRequest, Conflict
 
 
 crud = Blueprint('crud', __name__)
@@ -48,8 +49,9 @@ def list():
 
     books, next_page_token = get_model().list(cursor=token)
 
-    return render_template(
-        "list.html",
+    return caching.render_page(
+        render_template, "list.html",
+        current_app.config['LIST_CACHE_MAX_AGE'],
         books=books,
         next_page_token=next_page_token)
 
@@ -61,8 +63,10 @@ def list_mine():
     if token:
         token = token.encode('utf-8')
 
-    books, next_page_token = get_model().list_by_user(
-        user_id=session['profile']['id'],
+    # Books are stored with the email of the user who added them, see add().
+    books, next_page_token = listings.list_by_user(
+        get_model(),
+        user_id=session['profile']['email'],
         cursor=token)
 
     return render_template(
@@ -71,10 +75,45 @@ def list_mine():
         next_page_token=next_page_token)
 
 
+# Fields left out of /books/export, which anyone can download: the names and
+# email addresses of the users who added the books.
+PRIVATE_FIELDS = ('createdBy', 'createdById')
+
+
+def _public(book):
+    return dict((k, v) for k, v in book.items() if k not in PRIVATE_FIELDS)
+
+
+@crud.route("/export")
+def export():
+    """
+    Streams every book as JSON lines, without the PRIVATE_FIELDS. The
+    response is compressed with gzip when the client accepts it.
+    """
+    # bulk uses concurrent.futures, which Python 2 doesn't have, so the app
+    # only needs it once the catalog is exported.
+    from bookshelf import bulk
+
+    chunks = bulk.iter_jsonl(_public(book) for book in get_model().iterate())
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if 'gzip' in request.accept_encodings:
+        chunks = bulk.gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype='application/x-ndjson',
+        headers=headers)
+
+
 @crud.route('/<id>')
 def view(id):
     book = get_model().read(id)
-    return render_template("view.html", book=book)
+    return caching.render_page(
+        render_template, "view.html",
+        current_app.config['VIEW_CACHE_MAX_AGE'],
+        book=book)
 
 
 @crud.route('/add', methods=['GET', 'POST'])
@@ -94,9 +133,11 @@ def add():
             data['createdById'] = session['profile']['email']
 
         book = get_model().create(data)
+        listings.book_saved(book)
 
-        q = tasks.get_books_queue()
-        q.enqueue(tasks.process_book, book['id'])
+        fingerprint = tasks.title_fingerprint(book.get('title'))
+        if fingerprint:
+            tasks.enqueue_book(book['id'], fingerprint)
 
         return redirect(url_for('.view', id=book['id']))
 
@@ -105,20 +146,49 @@ def add():
 
 @crud.route('/<id>/edit', methods=['GET', 'POST'])
 def edit(id):
-    book = get_model().read(id)
+    # The book is compared with the form to find the changes, and its version
+    # is checked by the update, so it must not come from a lagging replica.
+    book = get_model().read(id, primary=True)
 
     if request.method == 'POST':
         data = request.form.to_dict(flat=True)
+        # The version of the book the form was filled in from.
+        version = data.pop('version', None)
 
         image_url = upload_image_file(request.files.get('image'))
 
         if image_url:
             data['imageUrl'] = image_url
 
-        book = get_model().update(data, id)
-
-        q = tasks.get_books_queue()
-        q.enqueue(tasks.process_book, book['id'])
+        # Only the fields that differ from the stored book are written. The
+        # others, such as the owner and the enrichment marker, which the
+        # form doesn't carry, are left as they are.
+        changes = dict(
+            (k, v) for k, v in data.items() if book.get(k) != v)
+
+        if version and not version.isdigit():
+            raise BadRequest('version must be an integer')
+
+        try:
+            book = get_model().update(
+                changes, id, version=int(version) if version else None)
+        except Conflict:
+            current = get_model().read(id, primary=True)
+            if current is None:
+                return redirect(url_for('.list'))
+            # Show the form again with the user's changes, at the current
+            # version, so that saving it again replaces the other changes.
+            book = dict(current, **data)
+            return render_template(
+                "form.html", action="Edit", book=book, conflict=True), 409
+        listings.book_saved(book)
+
+        # Only look the book up again if its title changed since it was last
+        # enriched. Edits to other fields don't need the worker.
+        fingerprint = tasks.title_fingerprint(book.get('title'))
+        if fingerprint and fingerprint != book.get('enrichedFingerprint'):
+            tasks.enqueue_book(
+                book['id'], fingerprint, book.get('enrichedFingerprint'))
 
         return redirect(url_for('.view', id=book['id']))
 
@@ -128,4 +198,5 @@ def edit(id):
 @crud.route('/<id>/delete')
 def delete(id):
     get_model().delete(id)
+    listings.book_deleted(id)
     return redirect(url_for('.list'))
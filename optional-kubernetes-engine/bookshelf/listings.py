@@ -0,0 +1,289 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-user book listings for the "My Books" page.
+
+Each process keeps the books of the users who looked at their list recently,
+sorted by title and with only the fields the list shows, so that paging
+through them doesn't query the backend. A user's listing is loaded with one
+pass over their books the first time they need it, and books created,
+edited or deleted through this process update it in place.
+
+Writes made by other processes, such as the worker enriching a book, are
+picked up when the listing expires after ``LISTINGS_MAX_AGE`` seconds. A
+user's own writes are picked up straight away on every process, as the time
+of their last write is kept in their session.
+
+At most ``LISTINGS_MAX_USERS`` listings are kept, the least recently used
+are dropped first, and users with more than ``LISTINGS_MAX_BOOKS`` books
+are left to the backend's paged query.
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+from flask import current_app, session
+
+
+# The fields shown on the list page, and the only ones kept.
+LISTING_FIELDS = ('id', 'title', 'author', 'imageUrl')
+
+# Books read per query when loading a listing.
+_LOAD_BATCH_SIZE = 500
+
+# Page tokens start with the kind of cursor they hold, as paging can move
+# between the listing and the backend when a listing is dropped or the user
+# gets too many books: an offset into the listing, or a cursor of the
+# backend's list_by_user.
+_LISTING_TOKEN = 'listing.'
+_BACKEND_TOKEN = 'backend.'
+
+
+def _entry(book):
+    return dict((field, book.get(field)) for field in LISTING_FIELDS)
+
+
+def _sort_key(book):
+    return (book.get('title') or u'', str(book['id']))
+
+
+class _Listing(object):
+    """One user's books, sorted by title."""
+
+    def __init__(self, books, loaded_at):
+        self.books = sorted(map(_entry, books), key=_sort_key)
+        self.keys = [_sort_key(book) for book in self.books]
+        self.loaded_at = loaded_at
+        # When the listing was last known to be up to date.
+        self.updated_at = loaded_at
+
+    def add(self, book):
+        key = _sort_key(book)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.books.insert(i, _entry(book))
+
+    def remove(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+            del self.books[i]
+
+
+class UserListings(object):
+    """The listings of up to ``max_users`` users. Safe to use from several
+    threads."""
+
+    def __init__(self, max_users, max_books, max_age):
+        self.max_users = max_users
+        self.max_books = max_books
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        # User id to _Listing, least recently used first.
+        self._listings = collections.OrderedDict()
+        # Book id to the user whose listing has it, and its sort key there.
+        self._owners = {}
+        # Users with too many books to keep, to when that was found.
+        self._oversized = {}
+
+    def __len__(self):
+        return len(self._listings)
+
+    def _fresh(self, loaded_at, updated_at, changed_at):
+        return (time.time() - loaded_at < self.max_age and
+                updated_at >= changed_at)
+
+    def page(self, user_id, offset, limit, changed_at=0):
+        """
+        Returns up to ``limit`` of the user's books from ``offset``, and the
+        offset of the next page or None. Returns None if the listing isn't
+        loaded, or was loaded before ``changed_at`` or too long ago.
+        """
+        with self._lock:
+            listing = self._listings.get(user_id)
+            if listing is None or not self._fresh(
+                    listing.loaded_at, listing.updated_at, changed_at):
+                return None
+            # Mark it as the most recently used.
+            del self._listings[user_id]
+            self._listings[user_id] = listing
+            books = listing.books[offset:offset + limit]
+            next_offset = offset + limit
+            if next_offset >= len(listing.books):
+                next_offset = None
+            return books, next_offset
+
+    def is_oversized(self, user_id, changed_at=0):
+        with self._lock:
+            found_at = self._oversized.get(user_id)
+            return (found_at is not None and
+                    self._fresh(found_at, found_at, changed_at))
+
+    def load(self, user_id, books):
+        """
+        Loads the listing of the user from ``books``, an iterable of all
+        their books. Returns False, without reading further, if the user
+        has more than ``max_books`` books.
+        """
+        # Writes made while the books are read may be missing, so the
+        # listing counts as loaded when reading started.
+        started = time.time()
+        loaded = []
+        for book in books:
+            if len(loaded) == self.max_books:
+                with self._lock:
+                    self._oversized[user_id] = started
+                    self._drop(user_id)
+                return False
+            loaded.append(book)
+
+        listing = _Listing(loaded, started)
+        with self._lock:
+            self._drop(user_id)
+            self._oversized.pop(user_id, None)
+            self._listings[user_id] = listing
+            for key in listing.keys:
+                self._owners[key[1]] = (user_id, key)
+            while len(self._listings) > self.max_users:
+                self._drop(next(iter(self._listings)))
+        return True
+
+    def _drop(self, user_id):
+        listing = self._listings.pop(user_id, None)
+        if listing is not None:
+            for key in listing.keys:
+                self._owners.pop(key[1], None)
+
+    def _remove(self, book_id, now):
+        owner = self._owners.pop(str(book_id), None)
+        if owner is not None:
+            user_id, key = owner
+            listing = self._listings[user_id]
+            listing.remove(key)
+            listing.updated_at = now
+
+    def saved(self, book, now):
+        """Updates the listings for a book that was created or edited at
+        ``now``."""
+        with self._lock:
+            self._remove(book['id'], now)
+            user_id = book.get('createdById')
+            listing = self._listings.get(user_id)
+            if listing is not None:
+                listing.add(book)
+                listing.updated_at = now
+                self._owners[str(book['id'])] = (user_id, _sort_key(book))
+
+    def deleted(self, book_id, now):
+        """Updates the listings for a book that was deleted at ``now``."""
+        with self._lock:
+            self._remove(book_id, now)
+
+
+def get_listings():
+    listings = current_app.extensions.get('user_listings')
+    if listings is None:
+        config = current_app.config
+        listings = current_app.extensions.setdefault(
+            'user_listings',
+            UserListings(
+                config.get('LISTINGS_MAX_USERS', 1000),
+                config.get('LISTINGS_MAX_BOOKS', 5000),
+                config.get('LISTINGS_MAX_AGE', 60)))
+    return listings
+
+
+def _iterate_user_books(model, user_id):
+    cursor = None
+    while True:
+        books, cursor = model.list_by_user(
+            user_id, limit=_LOAD_BATCH_SIZE, cursor=cursor)
+        for book in books:
+            yield book
+        if not cursor:
+            return
+
+
+def _parse_token(token):
+    """Returns the listing offset and the backend cursor in a page token,
+    either of which may be None."""
+    if isinstance(token, bytes):
+        token = token.decode('utf-8')
+    if token and token.startswith(_LISTING_TOKEN):
+        offset = token[len(_LISTING_TOKEN):]
+        if offset.isdigit():
+            return int(offset), None
+    elif token and token.startswith(_BACKEND_TOKEN):
+        return None, token[len(_BACKEND_TOKEN):]
+    return None, None
+
+
+def _backend_page(model, user_id, limit, offset):
+    """Returns the page of the user's books at ``offset`` from the backend.
+    Backends with opaque cursors can't start at an offset, so the books
+    before it are read too."""
+    cursor = None
+    while offset:
+        books, cursor = model.list_by_user(
+            user_id, limit=min(offset, _LOAD_BATCH_SIZE), cursor=cursor)
+        offset -= len(books)
+        if not books or not cursor:
+            return [], None
+    return model.list_by_user(user_id, limit=limit, cursor=cursor)
+
+
+def list_by_user(model, user_id, limit=10, cursor=None):
+    """
+    Returns a page of the user's books ordered by title and the token of
+    the next page, like ``model.list_by_user``. Pages come from the user's
+    listing, which is loaded first if needed, unless the user has too many
+    books to keep.
+    """
+    listings = get_listings()
+    changed_at = session.get('books_changed_at', 0)
+    offset, backend_cursor = _parse_token(cursor)
+
+    if backend_cursor is None:
+        if not listings.is_oversized(user_id, changed_at):
+            page = listings.page(user_id, offset or 0, limit, changed_at)
+            if page is None and listings.load(
+                    user_id, _iterate_user_books(model, user_id)):
+                page = listings.page(user_id, offset or 0, limit)
+            if page is not None:
+                books, next_offset = page
+                return books, (_LISTING_TOKEN + str(next_offset)
+                               if next_offset else None)
+        books, next_cursor = _backend_page(model, user_id, limit, offset)
+    else:
+        books, next_cursor = model.list_by_user(
+            user_id, limit=limit, cursor=backend_cursor)
+    return books, (_BACKEND_TOKEN + str(next_cursor)
+                   if next_cursor else None)
+
+
+def book_saved(book):
+    """Records that ``book`` was created or edited by the current user."""
+    now = time.time()
+    get_listings().saved(book, now)
+    session['books_changed_at'] = now
+
+
+def book_deleted(book_id):
+    """Records that the book was deleted by the current user."""
+    now = time.time()
+    get_listings().deleted(book_id, now)
+    session['books_changed_at'] = now
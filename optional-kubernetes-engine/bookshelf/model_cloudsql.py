@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask
+from flask import current_app, Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, select
+from werkzeug.exceptions import Conflict
 
 
 builtin_list = list
@@ -27,11 +29,35 @@ def init_app(app):
     app.config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
     db.init_app(app)
 
+    if 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        replica = db.get_engine(app, bind='replica')
+        read_session = db.create_scoped_session(
+            options={'binds': {Book.__table__: replica}})
+
+        @app.teardown_appcontext
+        def _remove_read_session(exception=None):
+            read_session.remove()
+    else:
+        read_session = db.session
+    app.extensions['bookshelf_read_session'] = read_session
+
+
+def get_read_session():
+    """
+    Returns the session used by the read-only functions of the current app.
+    It queries the read replica if a 'replica' bind is configured, and is the
+    regular session otherwise.
+    """
+    return current_app.extensions.get('bookshelf_read_session', db.session)
+
 
 def from_sql(row):
     """Translates a SQLAlchemy model instance into a dictionary"""
+    # Reading the id first loads the columns of an instance expired by a
+    # commit, which __dict__ doesn't hold otherwise.
+    id = row.id
     data = row.__dict__.copy()
-    data['id'] = row.id
+    data['id'] = id
     data.pop('_sa_instance_state')
     return data
 
@@ -47,36 +73,100 @@ class Book(db.Model):
     description = db.Column(db.String(4096))
     createdBy = db.Column(db.String(255))
     createdById = db.Column(db.String(255))
+    enrichedFingerprint = db.Column(db.String(40))
+    # Incremented by every update, see update().
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='0')
+
+    # The list pages sort by title, and the list of a user's books filters
+    # by createdById as well.
+    __table_args__ = (
+        db.Index('ix_books_title', 'title'),
+        db.Index('ix_books_createdById_title', 'createdById', 'title'),
+    )
 
     def __repr__(self):
         return "<Book(title='%s', author=%s)" % (self.title, self.author)
 
 
-def list(limit=10, cursor=None):
-    cursor = int(cursor) if cursor else 0
-    query = (Book.query
-             .order_by(Book.title)
+# The columns shown on the book list pages, and the only ones the list
+# queries read.
+LIST_COLUMNS = ('id', 'title', 'author', 'imageUrl')
+
+
+def _list_query(limit, offset, **filters):
+    books = Book.__table__
+    query = (select([books.c[name] for name in LIST_COLUMNS])
+             .order_by(books.c.title)
              .limit(limit)
-             .offset(cursor))
-    books = builtin_list(map(from_sql, query.all()))
-    next_page = cursor + limit if len(books) == limit else None
-    return (books, next_page)
+             .offset(offset))
+    for name, value in filters.items():
+        query = query.where(books.c[name] == value)
+    return query
 
 
-def list_by_user(user_id, limit=10, cursor=None):
+def _list_page(limit, cursor, **filters):
+    """
+    Returns a page of books ordered by title with only the LIST_COLUMNS, and
+    the cursor of the next page. Rows are read with SQLAlchemy Core rather
+    than the ORM, so the description isn't read and no Book instances are
+    built and tracked.
+    """
     cursor = int(cursor) if cursor else 0
-    query = (Book.query
-             .filter_by(createdById=user_id)
-             .order_by(Book.title)
-             .limit(limit)
-             .offset(cursor))
-    books = builtin_list(map(from_sql, query.all()))
+    query = _list_query(limit, cursor, **filters)
+    books = [dict(row) for row in get_read_session().execute(query)]
     next_page = cursor + limit if len(books) == limit else None
     return (books, next_page)
 
 
-def read(id):
-    result = Book.query.get(id)
+def list(limit=10, cursor=None):
+    return _list_page(limit, cursor)
+
+
+def list_by_user(user_id, limit=10, cursor=None):
+    return _list_page(limit, cursor, createdById=user_id)
+
+
+def _iterate_query(last_id, batch_size):
+    books = Book.__table__
+    return (books.select()
+            .where(books.c.id > last_id)
+            .order_by(books.c.id)
+            .limit(batch_size))
+
+
+def iterate(batch_size=1000):
+    """Yields every book, fetching ``batch_size`` books per query. Rows are
+    read with keyset pagination on the primary key and bypass the ORM so
+    that memory use doesn't grow with the number of books."""
+    read_session = get_read_session()
+    last_id = 0
+
+    while True:
+        query = _iterate_query(last_id, batch_size)
+        rows = read_session.execute(query).fetchall()
+
+        for row in rows:
+            yield dict(row)
+
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]['id']
+
+
+def read(id, primary=False):
+    """
+    Returns the book, or None if there is none. The book is read from the
+    read replica if there is one, which may lag behind. Pass ``primary`` to
+    read it from the primary instead when it is read to be changed and
+    written back.
+    """
+    read_session = db.session if primary else get_read_session()
+    result = read_session.query(Book).get(id)
+    if not result and read_session is not db.session:
+        # The book may have been created moments ago and not have reached
+        # the replica yet.
+        result = Book.query.get(id)
     if not result:
         return None
     return from_sql(result)
@@ -89,12 +179,54 @@ def create(data):
     return from_sql(book)
 
 
-def update(data, id):
-    book = Book.query.get(id)
-    for k, v in data.items():
-        setattr(book, k, v)
+def create_multi(data_list, return_ids=False):
+    """Creates many books in a single transaction. Any ids in the data are
+    ignored and new ids are assigned."""
+    columns = [column.name for column in Book.__table__.columns
+               if column.name not in ('id', 'version')]
+    rows = [dict((name, data.get(name)) for name in columns)
+            for data in data_list]
+
+    if return_ids:
+        # Reading back generated ids takes one INSERT per row, but the batch
+        # is still written in a single transaction.
+        books = [Book(**row) for row in rows]
+        db.session.bulk_save_objects(books, return_defaults=True)
+        db.session.commit()
+        return [book.id for book in books]
+
+    # Without ids the rows can go in as a single executemany.
+    db.session.execute(Book.__table__.insert(), rows)
     db.session.commit()
-    return from_sql(book)
+
+
+def update(data, id, version=None):
+    """
+    Sets the book's columns that are in ``data`` and returns the book. Only
+    those columns are in the UPDATE, so pass the ones that changed. Every
+    write increments the book's ``version``.
+
+    If ``version`` is given, the book is only written if it is still at that
+    version, and Conflict is raised if it was changed or deleted since. The
+    check is part of the UPDATE statement, so no lock is held between reading
+    the book and writing it.
+    """
+    books = Book.__table__
+    values = dict((k, v) for k, v in data.items()
+                  if k in books.c and k not in ('id', 'version'))
+    values['version'] = books.c.version + 1
+    query = books.update().where(books.c.id == id).values(values)
+    if version is not None:
+        query = query.where(books.c.version == version)
+
+    result = db.session.execute(query)
+    db.session.commit()
+    if not result.rowcount:
+        if version is not None:
+            raise Conflict('Book {} is no longer at version {}'.format(
+                id, version))
+        return None
+    return from_sql(Book.query.get(id))
 
 
 def delete(id):
@@ -102,16 +234,98 @@ def delete(id):
     db.session.commit()
 
 
+def create_indexes():
+    """
+    Creates the indexes declared on Book that don't exist yet. create_all
+    only creates them along with the table, so this adds them to a table
+    created before they were declared. Safe to run more than once.
+    """
+    engine = db.get_engine()
+    existing = set(
+        index['name']
+        for index in inspect(engine).get_indexes(Book.__tablename__))
+    created = []
+    for index in Book.__table__.indexes:
+        if index.name not in existing:
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+
+def _explain_sqlite(session, sql):
+    rows = session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    plan = [row[-1] for row in rows]
+    problems = []
+    for step in plan:
+        if step.startswith('SCAN') and 'INDEX' not in step:
+            problems.append('full scan')
+        if 'TEMP B-TREE' in step:
+            problems.append('sort')
+    return plan, problems
+
+
+def _explain_mysql(session, sql):
+    rows = session.execute('EXPLAIN ' + sql).fetchall()
+    plan = []
+    problems = []
+    for row in rows:
+        row = dict(row)
+        plan.append(
+            '{table}: type={type} key={key} rows={rows} {Extra}'.format(
+                **row))
+        if row['type'] == 'ALL':
+            problems.append('full scan')
+        if 'Using filesort' in (row['Extra'] or ''):
+            problems.append('filesort')
+    return plan, problems
+
+
+def explain_queries():
+    """
+    Runs EXPLAIN on every query this module makes. Returns a list of the
+    query name, the plan as a list of lines, and the problems found: full
+    table scans and sorts that don't use an index. Supports MySQL and
+    SQLite.
+
+    The database chooses plans by the data it holds, so run this against a
+    database with a realistic number of books.
+    """
+    books = Book.__table__
+    queries = [
+        ('list', _list_query(10, 0)),
+        ('list_by_user', _list_query(10, 0, createdById='user')),
+        ('read', books.select().where(books.c.id == 1)),
+        ('iterate', _iterate_query(0, 1000)),
+    ]
+
+    dialect = db.get_engine().dialect
+    if dialect.name == 'sqlite':
+        explain = _explain_sqlite
+    elif dialect.name == 'mysql':
+        explain = _explain_mysql
+    else:
+        raise ValueError("Can't explain queries on {}".format(dialect.name))
+
+    results = []
+    for name, query in queries:
+        sql = str(query.compile(
+            dialect=dialect, compile_kwargs={'literal_binds': True}))
+        plan, problems = explain(get_read_session(), sql)
+        results.append((name, plan, problems))
+    return results
+
+
 def _create_database():
     """
     If this script is run directly, create all the tables necessary to run the
-    application.
+    application, and any of their indexes that are missing.
     """
     app = Flask(__name__)
     app.config.from_pyfile('../config.py')
     init_app(app)
     with app.app_context():
         db.create_all()
+        create_indexes()
     print("All tables created")
 
 
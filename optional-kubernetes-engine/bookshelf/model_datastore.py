@@ -12,19 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+
 from flask import current_app
-from google.cloud import datastore
+from google.cloud import datastore, exceptions
+from werkzeug.exceptions import Conflict
 
 
 builtin_list = list
 
 
+# Datastore clients are thread-safe and expensive to create, so one client per
+# project is shared by every request in the process.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
 def init_app(app):
     pass
 
 
 def get_client():
-    return datastore.Client(current_app.config['PROJECT_ID'])
+    project = current_app.config['PROJECT_ID']
+    client = _clients.get(project)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(project)
+            if client is None:
+                client = _clients[project] = datastore.Client(project)
+    return client
 
 
 def from_datastore(entity):
@@ -63,11 +79,13 @@ def list(limit=10, cursor=None):
 
 def list_by_user(user_id, limit=10, cursor=None):
     ds = get_client()
+    # Needs the composite index in index.yaml.
     query = ds.query(
         kind='Book',
         filters=[
             ('createdById', '=', user_id)
-        ]
+        ],
+        order=['title']
     )
 
     query_iterator = query.fetch(limit=limit, start_cursor=cursor)
@@ -81,32 +99,101 @@ def list_by_user(user_id, limit=10, cursor=None):
     return entities, next_cursor
 
 
-def read(id):
+def iterate(batch_size=1000):
+    """Yields every book, fetching ``batch_size`` books per round trip."""
+    ds = get_client()
+    query = ds.query(kind='Book', order=['__key__'])
+    cursor = None
+
+    while True:
+        query_iterator = query.fetch(limit=batch_size, start_cursor=cursor)
+        page = builtin_list(next(query_iterator.pages))
+
+        for entity in page:
+            yield from_datastore(entity)
+
+        cursor = query_iterator.next_page_token
+        if not cursor or len(page) < batch_size:
+            return
+
+
+def read(id, primary=False):
+    """Returns the book, or None if there is none. Lookups by key are
+    strongly consistent, so ``primary`` makes no difference."""
     ds = get_client()
     key = ds.key('Book', int(id))
     results = ds.get(key)
     return from_datastore(results)
 
 
-def update(data, id=None):
+def update(data, id=None, version=None):
+    """
+    Sets the fields of the book that are in ``data`` and returns the book, or
+    creates a new book if ``id`` is None. Every write increments the book's
+    ``version``, which is 0 for books stored before books had one.
+
+    If ``version`` is given, the book is only written if it is still at that
+    version, and Conflict is raised if it was changed or deleted since.
+    Datastore can't make a put conditional or write only some properties, so
+    the book is read, changed and put in a transaction on that one entity.
+    Only the index entries of the properties that changed are rewritten.
+    """
     ds = get_client()
-    if id:
-        key = ds.key('Book', int(id))
-    else:
-        key = ds.key('Book')
+    data = dict((k, v) for k, v in data.items() if k not in ('id', 'version'))
 
-    entity = datastore.Entity(
-        key=key,
-        exclude_from_indexes=['description'])
+    if not id:
+        entity = datastore.Entity(
+            key=ds.key('Book'), exclude_from_indexes=['description'])
+        entity.update(data)
+        entity['version'] = 1
+        ds.put(entity)
+        return from_datastore(entity)
 
-    entity.update(data)
-    ds.put(entity)
+    key = ds.key('Book', int(id))
+    try:
+        with ds.transaction():
+            entity = ds.get(key)
+            if version is not None and (
+                    entity is None or entity.get('version', 0) != version):
+                raise Conflict('Book {} is no longer at version {}'.format(
+                    id, version))
+            if entity is None:
+                entity = datastore.Entity(
+                    key=key, exclude_from_indexes=['description'])
+            entity.update(data)
+            entity['version'] = entity.get('version', 0) + 1
+            ds.put(entity)
+    except exceptions.Conflict:
+        # The transaction was aborted by a concurrent write.
+        raise Conflict('Book {} was changed by another write'.format(id))
     return from_datastore(entity)
 
 
 create = update
 
 
+def create_multi(data_list, return_ids=False):
+    """Creates many books with as few round trips as possible. Any ids in
+    the data are ignored and new ids are allocated."""
+    ds = get_client()
+
+    entities = []
+    for data in data_list:
+        entity = datastore.Entity(
+            key=ds.key('Book'),
+            exclude_from_indexes=['description'])
+        entity.update((k, v) for k, v in data.items() if k != 'id')
+        entity['version'] = 1
+        entities.append(entity)
+
+    # Datastore accepts at most 500 entities per commit.
+    for start in range(0, len(entities), 500):
+        ds.put_multi(entities[start:start + 500])
+
+    if return_ids:
+        return [entity.key.id for entity in entities]
+
+
 def delete(id):
     ds = get_client()
     key = ds.key('Book', int(id))
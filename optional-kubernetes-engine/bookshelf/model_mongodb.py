@@ -14,6 +14,8 @@
 
 from bson.objectid import ObjectId
 from flask_pymongo import PyMongo
+from pymongo import ASCENDING, ReturnDocument
+from werkzeug.exceptions import Conflict
 
 
 builtin_list = list
@@ -21,6 +23,13 @@ builtin_list = list
 
 mongo = None
 
+# The indexes the queries below need. The list pages sort by title, and the
+# list of a user's books filters by createdById as well.
+INDEXES = [
+    [('title', ASCENDING)],
+    [('createdById', ASCENDING), ('title', ASCENDING)],
+]
+
 
 def _id(id):
     if not isinstance(id, ObjectId):
@@ -48,13 +57,15 @@ def init_app(app):
     mongo = PyMongo(app)
 
 
+def _list_cursor(query, limit, skip):
+    return mongo.db.books.find(query, skip=skip, limit=limit).sort('title')
+
+
 # [START list_by_user]
 def list_by_user(user_id, limit=10, cursor=None):
     cursor = int(cursor) if cursor else 0
 
-    results = mongo.db.books\
-        .find({'createdById': user_id}, skip=cursor, limit=10)\
-        .sort('title')
+    results = _list_cursor({'createdById': user_id}, limit, cursor)
     books = builtin_list(map(from_mongo, results))
 
     next_page = cursor + limit if len(books) == limit else None
@@ -66,7 +77,7 @@ def list_by_user(user_id, limit=10, cursor=None):
 def list(limit=10, cursor=None):
     cursor = int(cursor) if cursor else 0
 
-    results = mongo.db.books.find(skip=cursor, limit=10).sort('title')
+    results = _list_cursor({}, limit, cursor)
     books = builtin_list(map(from_mongo, results))
 
     next_page = cursor + limit if len(books) == limit else None
@@ -74,8 +85,24 @@ def list(limit=10, cursor=None):
 # [END list]
 
 
+def _iterate_cursor():
+    return mongo.db.books.find().sort('_id')
+
+
+def iterate(batch_size=1000):
+    """Yields every book from a single server-side cursor, fetching
+    ``batch_size`` books per round trip."""
+    results = _iterate_cursor().batch_size(batch_size)
+    for result in results:
+        book = from_mongo(result)
+        del book['_id']
+        yield book
+
+
 # [START read]
-def read(id):
+def read(id, primary=False):
+    """Returns the book, or None if there is none. Reads go to the primary,
+    so ``primary`` makes no difference."""
     result = mongo.db.books.find_one({'_id': _id(id)})
     return from_mongo(result)
 # [END read]
@@ -83,17 +110,99 @@ def read(id):
 
 # [START create]
 def create(data):
-    result = mongo.db.books.insert_one(data)
-    return read(result.inserted_id)
+    data['version'] = 1
+    # insert_one adds the new _id to data, so there is no need to read the
+    # book back.
+    mongo.db.books.insert_one(data)
+    return from_mongo(data)
 # [END create]
 
 
 # [START update]
-def update(data, id):
-    mongo.db.books.replace_one({'_id': _id(id)}, data)
-    return read(id)
+def update(data, id, version=None):
+    """
+    Sets the fields of the book that are in ``data`` with ``$set``, so that
+    the rest of the book isn't rewritten, and returns the book. Every write
+    increments the book's ``version``, which is 0 for books stored before
+    books had one.
+
+    If ``version`` is given, the book is only written if it is still at that
+    version, and Conflict is raised if it was changed or deleted since.
+    """
+    query = {'_id': _id(id)}
+    if version is not None:
+        # Books stored before books had a version don't have the field.
+        query['version'] = version or {'$in': [0, None]}
+
+    changes = {'$inc': {'version': 1}}
+    fields = dict((k, v) for k, v in data.items()
+                  if k not in ('id', '_id', 'version'))
+    if fields:
+        changes['$set'] = fields
+    result = mongo.db.books.find_one_and_update(
+        query, changes, return_document=ReturnDocument.AFTER)
+    if result is None and version is not None:
+        raise Conflict('Book {} is no longer at version {}'.format(
+            id, version))
+    return from_mongo(result)
 # [END update]
 
 
+def create_multi(data_list, return_ids=False):
+    """Creates many books in a single round trip. Any ids in the data are
+    ignored and new ids are assigned."""
+    books = [
+        dict(((k, v) for k, v in data.items() if k not in ('id', '_id')),
+             version=1)
+        for data in data_list]
+    result = mongo.db.books.insert_many(books, ordered=False)
+    if return_ids:
+        return [str(id) for id in result.inserted_ids]
+
+
 def delete(id):
     mongo.db.books.delete_one({'_id': _id(id)})
+
+
+def create_indexes():
+    """Creates the INDEXES that don't exist yet. Safe to run more than
+    once."""
+    return [mongo.db.books.create_index(keys) for keys in INDEXES]
+
+
+def _plan_stages(plan):
+    """Yields the stages of a query plan, from the last to the first."""
+    yield plan
+    for child in plan.get('inputStages', []) + [
+            plan[key] for key in ('inputStage', 'queryPlan') if key in plan]:
+        for stage in _plan_stages(child):
+            yield stage
+
+
+def explain_queries():
+    """
+    Runs explain on every query this module makes. Returns a list of the
+    query name, the winning plan's stages, and the problems found:
+    collection scans and sorts that don't use an index.
+
+    MongoDB chooses plans by the data it holds, so run this against a
+    database with a realistic number of books.
+    """
+    queries = [
+        ('list', _list_cursor({}, 10, 0)),
+        ('list_by_user', _list_cursor({'createdById': 'user'}, 10, 0)),
+        ('read', mongo.db.books.find({'_id': ObjectId()}).limit(1)),
+        ('iterate', _iterate_cursor()),
+    ]
+
+    results = []
+    for name, query in queries:
+        plan = query.explain()['queryPlanner']['winningPlan']
+        stages = [stage['stage'] for stage in _plan_stages(plan)]
+        problems = []
+        if 'COLLSCAN' in stages:
+            problems.append('collection scan')
+        if 'SORT' in stages:
+            problems.append('sort')
+        results.append((name, stages, problems))
+    return results
@@ -0,0 +1,164 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+On-demand profiling of a running worker process. Profiles are returned in
+the folded stack format, one stack per line with its frames separated by
+semicolons followed by a count, which flamegraph.pl and speedscope read.
+
+Nothing runs between profiles: stacks are only sampled, and allocations only
+traced, for the duration of a profile request.
+"""
+
+import collections
+import hmac
+import sys
+import threading
+import time
+
+from flask import current_app, request, Response
+from werkzeug.exceptions import BadRequest, Conflict, Forbidden
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+# Only one profile runs at a time in a process, since tracing allocations
+# affects the whole process.
+_lock = threading.Lock()
+
+
+def _frame_name(filename, function, lineno):
+    return '{} ({}:{})'.format(function, filename, lineno)
+
+
+def _folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(_frame_name(
+            code.co_filename, code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def sample_stacks(seconds, interval):
+    """
+    Samples the stack of every other thread in the process every ``interval``
+    seconds for ``seconds``. Returns a Counter of folded stacks.
+
+    This is a wall clock profile: threads blocked on I/O or waiting for a
+    request are sampled as well.
+    """
+    current = threading.current_thread().ident
+    samples = collections.Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != current:
+                samples[_folded_stack(frame)] += 1
+        time.sleep(interval)
+    return samples
+
+
+def trace_allocations(seconds, frames=32):
+    """
+    Traces memory allocations for ``seconds``. Returns a Counter of folded
+    stacks to the number of bytes allocated there during that time and still
+    alive at the end of it.
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(frames)
+    try:
+        before = tracemalloc.take_snapshot()
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+
+    allocations = collections.Counter()
+    for stat in after.compare_to(before, 'traceback'):
+        if stat.size_diff > 0:
+            # Frames are ordered from the oldest call to the most recent.
+            stack = ';'.join(
+                '{}:{}'.format(frame.filename, frame.lineno)
+                for frame in stat.traceback)
+            allocations[stack] += stat.size_diff
+    return allocations
+
+
+def format_folded(counts):
+    return ''.join(
+        '{} {}\n'.format(stack, count)
+        for stack, count in counts.most_common())
+
+
+def _check_token():
+    token = current_app.config['PROFILING_TOKEN']
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(header.encode('utf-8'),
+                               'Bearer {}'.format(token).encode('utf-8')):
+        raise Forbidden()
+
+
+def _float_arg(name, default, minimum, maximum):
+    try:
+        value = float(request.args.get(name, default))
+    except ValueError:
+        raise BadRequest('{} must be a number'.format(name))
+    if not minimum <= value <= maximum:
+        raise BadRequest('{} must be between {} and {}'.format(
+            name, minimum, maximum))
+    return value
+
+
+def profile():
+    """
+    Profiles this worker process for ``seconds`` and returns the profile as
+    folded stacks. ``mode=cpu``, the default, samples every thread's stack
+    ``hz`` times a second. ``mode=memory`` traces the allocations made.
+
+    Requires an ``Authorization: Bearer <PROFILING_TOKEN>`` header.
+    """
+    _check_token()
+
+    mode = request.args.get('mode', 'cpu')
+    if mode not in ('cpu', 'memory'):
+        raise BadRequest('mode must be cpu or memory')
+    if mode == 'memory' and tracemalloc is None:
+        raise BadRequest('Memory profiles require Python 3.')
+    seconds = _float_arg(
+        'seconds', 10, 0, current_app.config['PROFILING_MAX_SECONDS'])
+    hz = _float_arg('hz', 100, 1, 1000)
+
+    if not _lock.acquire(False):
+        raise Conflict('A profile is already running in this worker.')
+    try:
+        if mode == 'cpu':
+            counts = sample_stacks(seconds, 1.0 / hz)
+        else:
+            counts = trace_allocations(seconds)
+    finally:
+        _lock.release()
+
+    return Response(
+        format_folded(counts),
+        mimetype='text/plain',
+        headers={'Content-Disposition':
+                 'attachment; filename={}.folded'.format(mode)})
@@ -17,13 +17,14 @@ from __future__ import absolute_import
 import datetime
 
 from flask import current_app
-from google.cloud import storage
 import six
 from werkzeug import secure_filename
 from werkzeug.exceptions import BadRequest
 
 
 def _get_storage_client():
+    # Imported here as only uploads need it, and it is slow to import.
+    from google.cloud import storage
     return storage.Client(
         project=current_app.config['PROJECT_ID'])
 
@@ -12,41 +12,171 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
+import threading
+import time
 
 from bookshelf import get_model, storage
 from flask import current_app
-from google.cloud import pubsub
-import psq
 import requests
+from werkzeug.exceptions import Conflict
 
 
-publisher_client = pubsub.PublisherClient()
-subscriber_client = pubsub.SubscriberClient()
+# How many times the worker merges its changes into a book that was edited
+# while it was being enriched before giving up.
+MAX_MERGE_ATTEMPTS = 5
+
+
+# The Pub/Sub clients, created by the first call to get_books_queue. Creating
+# them, and importing psq and the Pub/Sub library, is slow, so it's left out
+# of the frontend's startup.
+_clients = None
+_clients_lock = threading.Lock()
+
+
+def _get_clients():
+    global _clients
+    with _clients_lock:
+        if _clients is None:
+            from google.cloud import pubsub
+            _clients = (pubsub.PublisherClient(), pubsub.SubscriberClient())
+    return _clients
 
 
 def get_books_queue():
+    """
+    Returns the app's books queue. The queue is created once per app and
+    reused for every request.
+    """
+    queue = current_app.extensions.get('books_queue')
+    if queue is not None:
+        return queue
+
+    import psq
+
+    publisher_client, subscriber_client = _get_clients()
     project = current_app.config['PROJECT_ID']
 
     # Create a queue specifically for processing books and pass in the
     # Flask application context. This ensures that tasks will have access
     # to any extensions / configuration specified to the app, such as
     # models.
-    return psq.Queue(
+    queue = psq.Queue(
         publisher_client, subscriber_client, project,
         'books', extra_context=current_app.app_context)
+    return current_app.extensions.setdefault('books_queue', queue)
+
+
+class TaskDebouncer(object):
+    """
+    Remembers which book tasks were enqueued recently so that repeated saves
+    of the same book collapse into a single task.
+
+    Tasks are keyed by book id. A task is only suppressed if one with the same
+    title fingerprint was enqueued within the window, for the book as it was
+    last enriched; the worker always reads the latest version of the book, so
+    the earlier task covers the later saves. Once the worker has enriched the
+    book, its ``enrichedFingerprint`` changes and the next save gets a new
+    task. The state is per process.
+    """
 
+    # Expired entries are pruned once the map grows past this size.
+    max_entries = 10000
 
-def process_book(book_id):
+    def __init__(self, window):
+        self.window = window
+        self._recent = {}
+        self._lock = threading.Lock()
+
+    def claim(self, book_id, fingerprint, enriched_fingerprint=None):
+        """
+        Returns True if a task for this book and fingerprint should be
+        enqueued, and records it as enqueued. ``enriched_fingerprint`` is the
+        book's ``enrichedFingerprint`` when it was saved.
+        """
+        now = time.time()
+        key = str(book_id)
+        task = (fingerprint, enriched_fingerprint)
+        with self._lock:
+            last = self._recent.get(key)
+            if (last and last[0] == task and
+                    now - last[1] < self.window):
+                return False
+            self._recent[key] = (task, now)
+            if len(self._recent) > self.max_entries:
+                self._prune(now)
+        return True
+
+    def release(self, book_id):
+        """Forgets a claim, for example when enqueueing failed."""
+        with self._lock:
+            self._recent.pop(str(book_id), None)
+
+    def _prune(self, now):
+        expired = [key for key, (_, enqueued_at) in self._recent.items()
+                   if now - enqueued_at >= self.window]
+        for key in expired:
+            del self._recent[key]
+
+
+def _get_debouncer():
+    debouncer = current_app.extensions.get('books_queue_debouncer')
+    if debouncer is None:
+        debouncer = current_app.extensions.setdefault(
+            'books_queue_debouncer',
+            TaskDebouncer(
+                current_app.config.get('BOOKS_QUEUE_DEBOUNCE_SECONDS', 30)))
+    return debouncer
+
+
+def enqueue_book(book_id, fingerprint, enriched_fingerprint=None):
+    """
+    Enqueues a task to process the book, unless an identical task was
+    enqueued within the last ``BOOKS_QUEUE_DEBOUNCE_SECONDS`` and the worker
+    hasn't enriched the book since. Returns True if a task was enqueued.
+    """
+    debouncer = _get_debouncer()
+    if not debouncer.claim(book_id, fingerprint, enriched_fingerprint):
+        logging.info("Task for book id {} already queued, skipping."
+                     .format(book_id))
+        return False
+
+    try:
+        get_books_queue().enqueue(process_book, book_id, fingerprint)
+    except Exception:
+        debouncer.release(book_id)
+        raise
+    return True
+
+
+def title_fingerprint(title):
+    """
+    Returns a short, stable fingerprint of a book title. Books store the
+    fingerprint of the title they were last enriched for, which lets both the
+    frontend and the worker tell whether a save needs another lookup.
+    """
+    if not title:
+        return None
+    normalized = ' '.join(title.split()).lower()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+
+
+def process_book(book_id, fingerprint=None):
     """
     Handles an individual Bookshelf message by looking it up in the
     model, querying the Google Books API, and updating the book in the model
     with the info found in the Books API.
+
+    ``fingerprint`` is the title fingerprint at the time the task was
+    enqueued. If the title has changed since then, a newer task is already
+    queued and this one is skipped. Books that were already enriched for their
+    current title are skipped without calling the Books API.
     """
 
     model = get_model()
 
-    book = model.read(book_id)
+    book = model.read(book_id, primary=True)
 
     if not book:
         logging.warn("Could not find book with id {}".format(book_id))
@@ -57,29 +187,94 @@ def process_book(book_id):
                      .format(book_id))
         return
 
+    current_fingerprint = title_fingerprint(book['title'])
+
+    if fingerprint and fingerprint != current_fingerprint:
+        logging.info("Title of book id {} changed since the task was queued, "
+                     "skipping.".format(book_id))
+        return
+
+    if book.get('enrichedFingerprint') == current_fingerprint:
+        logging.info("Book id {} is already enriched for its title, "
+                     "skipping.".format(book_id))
+        return
+
     logging.info("Looking up book with title {}".format(book[
                                                         'title']))
 
     new_book_data = query_books_api(book['title'])
 
-    if not new_book_data:
-        return
+    changes = {}
+    if new_book_data:
+        changes = _enrichment_changes(book, new_book_data)
 
-    book['title'] = new_book_data.get('title')
-    book['author'] = ', '.join(new_book_data.get('authors', []))
-    book['publishedDate'] = new_book_data.get('publishedDate')
-    book['description'] = new_book_data.get('description')
+    # Record the title this book was enriched for, even when the Books API
+    # had nothing, so that saving the same title again doesn't repeat the
+    # lookup.
+    changes['enrichedFingerprint'] = title_fingerprint(
+        changes.get('title') or book['title'])
+
+    _save_changes(model, book_id, book, changes, current_fingerprint)
+
+
+def _save_changes(model, book_id, book, changes, fingerprint):
+    """
+    Writes ``changes``, the fields that differ from ``book``, to the book if
+    it wasn't changed since ``book`` was read. The rest of the book isn't
+    written.
+
+    If the book was changed since, the changes are merged into the latest
+    book instead of looking it up again: fields that were changed since keep
+    their new value, and the others get the worker's. The book is skipped if
+    its title no longer has ``fingerprint``, as a newer task will enrich it.
+    """
+    latest = book
+    for _ in range(MAX_MERGE_ATTEMPTS):
+        try:
+            model.update(changes, book_id, version=latest.get('version', 0))
+            return
+        except Conflict:
+            pass
+
+        latest = model.read(book_id, primary=True)
+        if not latest:
+            logging.info("Book id {} was deleted while it was being "
+                         "enriched.".format(book_id))
+            return
+        if title_fingerprint(latest.get('title')) != fingerprint:
+            logging.info("Title of book id {} changed while it was being "
+                         "enriched, skipping.".format(book_id))
+            return
+        changes = dict((k, v) for k, v in changes.items()
+                       if latest.get(k) == book.get(k))
+
+    logging.warn("Book id {} kept changing while it was being enriched, "
+                 "giving up.".format(book_id))
+
+
+def _enrichment_changes(book, new_book_data):
+    """
+    Returns the fields of ``book`` that differ from the information found in
+    the Books API.
+    """
+    enriched = {
+        'title': new_book_data.get('title'),
+        'author': ', '.join(new_book_data.get('authors', [])),
+        'publishedDate': new_book_data.get('publishedDate'),
+        'description': new_book_data.get('description'),
+    }
 
     # If the new book data has thumbnail images and there isn't currently a
     # thumbnail for the book, then copy the image to cloud storage and update
     # the book data.
     if not book.get('imageUrl') and 'imageLinks' in new_book_data:
         new_img_src = new_book_data['imageLinks']['smallThumbnail']
-        book['imageUrl'] = download_and_upload_image(
+        enriched['imageUrl'] = download_and_upload_image(
             new_img_src,
-            "{}.jpg".format(book['title']))
+            "{}.jpg".format(enriched['title']))
 
-    model.update(book, book_id)
+    return dict(
+        (k, v) for k, v in enriched.items() if book.get(k) != v)
 
 
 def query_books_api(title):
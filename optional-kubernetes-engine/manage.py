@@ -0,0 +1,228 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Command line tools for managing the Bookshelf data. The data backend is
+configured in config.py, the same as for the web application.
+
+To load books from a JSON lines or CSV file:
+
+    $ python manage.py import books.jsonl --batch-size 500 --workers 8
+
+To dump every book to a JSON lines file, gzip compressed:
+
+    $ python manage.py export books.jsonl.gz
+
+To copy every book from one backend to another and verify the copy:
+
+    $ python manage.py migrate datastore cloudsql
+
+The migration records a source to target id mapping in a checkpoint file as
+it goes. Running it again with the same checkpoint resumes where it left off,
+and books from a batch that was being written when it stopped are only copied
+if they didn't reach the target.
+
+To create the indexes the Cloud SQL or MongoDB backend needs, and then check
+that none of its queries scans every book or sorts without an index:
+
+    $ python manage.py create-indexes
+    $ python manage.py explain
+"""
+
+import argparse
+import sys
+import time
+
+import bookshelf
+from bookshelf import bulk
+import config
+
+
+def import_command(app, args):
+    with app.app_context():
+        model = bookshelf.get_model()
+
+    count, elapsed = bulk.import_books(
+        app, model, bulk.read_books(args.path),
+        batch_size=args.batch_size,
+        workers=args.workers)
+
+    print("Imported {} books in {:.1f}s ({:.0f} books/sec)".format(
+        count, elapsed, count / elapsed if elapsed else count))
+
+
+def export_command(app, args):
+    start = time.time()
+    with app.app_context():
+        books = bookshelf.get_model().iterate(batch_size=args.batch_size)
+        if args.path == '-':
+            count = 0
+            for line in bulk.iter_jsonl(books):
+                sys.stdout.write(line)
+                count += 1
+        else:
+            count = bulk.export_books(books, args.path)
+
+    # Keep stdout clean when the books are written to it.
+    sys.stderr.write("Exported {} books in {:.1f}s\n".format(
+        count, time.time() - start))
+
+
+def _init_model(app, backend):
+    """Returns the model for ``backend``, initializing it for the app if it
+    isn't the configured backend."""
+    model = bookshelf.get_model(backend)
+    if backend != app.config['DATA_BACKEND']:
+        model.init_app(app)
+    return model
+
+
+def migrate_command(app, args):
+    if args.source == args.target:
+        sys.exit("The source and target backends must be different.")
+
+    checkpoint = args.checkpoint or 'migrate-{}-{}.jsonl'.format(
+        args.source, args.target)
+
+    with app.app_context():
+        source = _init_model(app, args.source)
+        target = _init_model(app, args.target)
+
+        if not args.verify_only:
+            count, elapsed = bulk.migrate_books(
+                app, source, target, checkpoint,
+                batch_size=args.batch_size,
+                workers=args.workers)
+            print("Copied {} books in {:.1f}s ({:.0f} books/sec), id "
+                  "mapping in {}".format(
+                      count, elapsed, count / elapsed if elapsed else count,
+                      checkpoint))
+
+        result = bulk.verify_migration(source, target)
+
+    print("{}: {source_count} books, checksum {source_checksum}".format(
+        args.source, **result))
+    print("{}: {target_count} books, checksum {target_checksum}".format(
+        args.target, **result))
+
+    if not result['ok']:
+        sys.exit("Verification failed, the backends don't match.")
+    print("Verification passed.")
+
+
+def _indexed_model(app, backend):
+    model = _init_model(app, backend)
+    if not hasattr(model, 'explain_queries'):
+        sys.exit("The {} backend has no indexes to manage.".format(backend))
+    return model
+
+
+def create_indexes_command(app, args):
+    backend = args.backend or app.config['DATA_BACKEND']
+    with app.app_context():
+        created = _indexed_model(app, backend).create_indexes()
+    print("Created {}".format(', '.join(created)) if created
+          else "All indexes exist.")
+
+
+def explain_command(app, args):
+    backend = args.backend or app.config['DATA_BACKEND']
+    with app.app_context():
+        results = _indexed_model(app, backend).explain_queries()
+
+    failed = False
+    for name, plan, problems in results:
+        print("{}: {}".format(name, ', '.join(problems) or 'ok'))
+        for line in plan:
+            print("    {}".format(line))
+        failed = failed or bool(problems)
+
+    if failed:
+        sys.exit("Some queries aren't using an index.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    import_parser = subparsers.add_parser(
+        'import', help='Bulk load books from a .jsonl or .csv file.')
+    import_parser.add_argument(
+        'path', help='File to import. May be gzip compressed (.gz).')
+    import_parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Number of books written per batch.')
+    import_parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of batches written in parallel.')
+    import_parser.set_defaults(func=import_command)
+
+    export_parser = subparsers.add_parser(
+        'export', help='Stream every book to a .jsonl file.')
+    export_parser.add_argument(
+        'path', help='File to write, or - for stdout. Compressed with gzip '
+        'if the name ends in .gz.')
+    export_parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='Number of books read per round trip.')
+    export_parser.set_defaults(func=export_command)
+
+    backends = ['datastore', 'cloudsql', 'mongodb']
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Copy every book from one backend to another.')
+    migrate_parser.add_argument('source', choices=backends)
+    migrate_parser.add_argument('target', choices=backends)
+    migrate_parser.add_argument(
+        '--checkpoint',
+        help='Id mapping and checkpoint file. Defaults to '
+        'migrate-<source>-<target>.jsonl.')
+    migrate_parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Number of books written per batch.')
+    migrate_parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of batches written in parallel.')
+    migrate_parser.add_argument(
+        '--verify-only', action='store_true',
+        help='Only compare book counts and checksums.')
+    migrate_parser.set_defaults(func=migrate_command)
+
+    create_indexes_parser = subparsers.add_parser(
+        'create-indexes',
+        help='Create the indexes the backend needs that are missing.')
+    create_indexes_parser.add_argument(
+        '--backend', choices=['cloudsql', 'mongodb'],
+        help='Defaults to the configured backend.')
+    create_indexes_parser.set_defaults(func=create_indexes_command)
+
+    explain_parser = subparsers.add_parser(
+        'explain', help='Check that every query of the backend uses an '
+        'index. Exits with an error if one scans every book or sorts '
+        'without an index.')
+    explain_parser.add_argument(
+        '--backend', choices=['cloudsql', 'mongodb'],
+        help='Defaults to the configured backend.')
+    explain_parser.set_defaults(func=explain_command)
+
+    args = parser.parse_args(argv)
+
+    app = bookshelf.create_app(config)
+    args.func(app, args)
+
+
+if __name__ == '__main__':
+    main()
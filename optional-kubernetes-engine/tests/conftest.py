@@ -43,6 +43,25 @@ def app(request):
         yield app
 
 
+@pytest.fixture
+def sqlite_app(tmpdir):
+    """A Cloud SQL app backed by a SQLite database in a temporary
+    directory."""
+    app = bookshelf.create_app(
+        config,
+        testing=True,
+        config_overrides={
+            'DATA_BACKEND': 'cloudsql',
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + str(tmpdir.join('bookshelf.db')),
+            'SQLALCHEMY_ENGINE_OPTIONS': {},
+            'SQLALCHEMY_BINDS': {},
+        })
+
+    with app.app_context():
+        yield app
+
+
 @pytest.fixture
 def model(monkeypatch, app):
     """This fixture provides a modified version of the app's model that tracks
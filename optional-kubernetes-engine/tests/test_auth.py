@@ -42,6 +42,7 @@ def client_with_credentials(app):
         with app.test_client() as client:
             with client.session_transaction() as session:
                 session['profile'] = {
+                    'id': '123',
                     'email': 'abc@example.com',
                     'name': 'Test User'
                 }
@@ -125,6 +126,16 @@ class TestAuth(object):
         assert 'Book 1' in body
         assert 'Book 2' not in body
 
+    def test_mine_added(self, client_with_credentials):
+        # Books added by the user are listed under the same identifier that
+        # "My Books" looks them up by, not the profile's id.
+        with client_with_credentials() as c:
+            c.post('/books/add', data={'title': 'Book 1'})
+            rv = c.get('/books/mine')
+
+        assert rv.status == '200 OK'
+        assert 'Book 1' in rv.data.decode('utf-8')
+
     @mock.patch("httplib2.Http")
     def test_request_user_info(self, HttpMock):
         httpObj = mock.MagicMock()
@@ -0,0 +1,140 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+
+from bookshelf import bulk
+from conftest import flaky_filter
+from flaky import flaky
+import flask
+import pytest
+
+
+# Mark all test cases in this class as flaky, so that if errors occur they
+# can be retried. This is useful when databases are temporarily unavailable.
+@flaky(rerun_filter=flaky_filter)
+# Tell pytest to use both the app and model fixtures for all test cases.
+# This ensures that configuration is properly applied and that all database
+# resources created during tests are cleaned up. These fixtures are defined
+# in conftest.py
+@pytest.mark.usefixtures('app', 'model')
+class TestBulk(object):
+
+    def test_import_jsonl(self, app, model, tmpdir):
+        path = tmpdir.join('books.jsonl')
+        path.write('\n'.join(
+            json.dumps({'title': u'Book {0}'.format(i), 'id': 'ignored'})
+            for i in range(25)))
+
+        count, _ = bulk.import_books(
+            app, model, bulk.read_books(str(path)),
+            batch_size=10, workers=2)
+
+        assert count == 25
+        books, _ = model.list(limit=50)
+        assert len(books) == 25
+        assert all(book['id'] != 'ignored' for book in books)
+
+    def test_import_csv(self, app, model, tmpdir):
+        path = tmpdir.join('books.csv')
+        path.write('title,author\nBook 1,Author 1\nBook 2,\n')
+
+        count, _ = bulk.import_books(app, model, bulk.read_books(str(path)))
+
+        assert count == 2
+        books, _ = model.list()
+        assert [book['title'] for book in books] == ['Book 1', 'Book 2']
+        assert books[0]['author'] == 'Author 1'
+        assert not books[1].get('author')
+
+    def test_export(self, model, tmpdir):
+        for i in range(1, 12):
+            model.create({'title': u'Book {0}'.format(i)})
+        path = str(tmpdir.join('books.jsonl.gz'))
+
+        count = bulk.export_books(model.iterate(batch_size=5), path)
+
+        assert count == 11
+        with gzip.open(path, 'rt') as f:
+            books = [json.loads(line) for line in f]
+        assert sorted(book['title'] for book in books) == sorted(
+            u'Book {0}'.format(i) for i in range(1, 12))
+
+
+def test_checksum_ignores_ids_and_order():
+    books = [
+        {'id': 1, 'title': 'Book 1', 'author': 'Author 1'},
+        {'id': 2, 'title': 'Book 2', 'description': None},
+    ]
+    migrated = [
+        {'id': 'b', '_id': 'b', 'title': 'Book 2'},
+        {'id': 'a', '_id': 'a', 'title': 'Book 1', 'author': 'Author 1'},
+    ]
+
+    assert bulk.checksum_books(books) == bulk.checksum_books(migrated)
+    assert bulk.checksum_books(books) != bulk.checksum_books(migrated[:1])
+
+
+def test_read_checkpoint(tmpdir):
+    path = tmpdir.join('checkpoint.jsonl')
+    assert bulk.read_checkpoint(str(path)) == {}
+
+    path.write('{"source": "1", "target": "a"}\n'
+               '{"source": "2", "target": "b"}\n')
+    assert bulk.read_checkpoint(str(path)) == {'1': 'a', '2': 'b'}
+
+
+class FakeModel(object):
+
+    def __init__(self, books=()):
+        self.books = dict((str(i), dict(book)) for i, book in enumerate(books))
+
+    def iterate(self, batch_size=None):
+        for book_id, book in sorted(self.books.items()):
+            yield dict(book, id=book_id)
+
+    def create_multi(self, books, return_ids=False):
+        ids = []
+        for book in books:
+            book_id = 'n{0}'.format(len(self.books))
+            self.books[book_id] = dict(
+                (k, v) for k, v in book.items() if k != 'id')
+            ids.append(book_id)
+        return ids
+
+
+def test_migrate_resumes_pending_batch(tmpdir):
+    source = FakeModel({'title': u'Book {0}'.format(i)} for i in range(5))
+    target = FakeModel()
+    # The first batch reached the target but the migration stopped before
+    # its ids were recorded.
+    target.create_multi([dict(book, id=None) for book in
+                         list(source.iterate())[:2]])
+    path = tmpdir.join('checkpoint.jsonl')
+    path.write('{"pending": ["0", "1"]}\n')
+
+    count, _ = bulk.migrate_books(
+        flask.Flask(__name__), source, target, str(path), batch_size=2)
+
+    assert count == 3
+    assert bulk.verify_migration(source, target)['ok']
+    assert sorted(bulk.read_checkpoint(str(path))) == ['0', '1', '2', '3', '4']
+
+
+def test_migrate_rejects_same_model(tmpdir):
+    model = FakeModel()
+    with pytest.raises(ValueError):
+        bulk.migrate_books(flask.Flask(__name__), model, model,
+                           str(tmpdir.join('checkpoint.jsonl')))
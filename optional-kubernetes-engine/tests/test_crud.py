@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import re
 
 from conftest import flaky_filter
@@ -44,6 +45,27 @@ class TestCrudActions(object):
             "Should not show more than 10 books")
         assert 'More' in body, "Should have more than one page"
 
+    def test_conditional_get(self, app, model):
+        book = model.create({'title': u'Book 1'})
+
+        with app.test_client() as c:
+            for path in ('/books/', '/books/{}'.format(book['id'])):
+                rv = c.get(path)
+                assert rv.status == '200 OK'
+                etag = rv.headers['ETag']
+                assert 'public' in rv.headers['Cache-Control']
+
+                rv = c.get(path, headers={'If-None-Match': etag})
+                assert rv.status == '304 NOT MODIFIED'
+                assert rv.data == b''
+
+            model.update({'title': u'Book 2'}, book['id'])
+            rv = c.get('/books/{}'.format(book['id']),
+                       headers={'If-None-Match': etag})
+
+        assert rv.status == '200 OK'
+        assert rv.headers['ETag'] != etag
+
     def test_add(self, app):
         data = {
             'title': 'Test Book',
@@ -86,3 +108,21 @@ class TestCrudActions(object):
 
         assert rv.status == '200 OK'
         assert not model.read(existing['id'])
+
+    def test_export(self, app, model):
+        for i in range(1, 12):
+            model.create({'title': u'Book {0}'.format(i),
+                          'createdBy': u'User', 'createdById': u'1'})
+
+        # The streamed response pushes its own request context, which must
+        # not be preserved past the request.
+        rv = app.test_client().get('/books/export')
+        data = rv.data
+
+        assert rv.status == '200 OK'
+        assert rv.mimetype == 'application/x-ndjson'
+        books = [json.loads(line)
+                 for line in data.decode('utf-8').splitlines()]
+        assert len(books) == 11
+        assert not any('createdBy' in book or 'createdById' in book
+                       for book in books)
@@ -28,7 +28,7 @@ def test_end_to_end():
     Unlike the integration tests in the other packages, these tests are
     designed to be run against fully-functional live environments.
 
-    To run locally, start both main.py and psq_worker main.books_queue and
+    To run locally, start both main.py and psq_worker worker.books_queue and
     run this file.
 
     It can be run against a live environment by setting the E2E_URL
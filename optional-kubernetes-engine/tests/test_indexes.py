@@ -0,0 +1,41 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf import model_cloudsql
+
+
+def test_cloudsql_indexes(sqlite_app):
+    db = model_cloudsql.db
+    db.create_all()
+    # A table created before the indexes were declared.
+    for index in model_cloudsql.Book.__table__.indexes:
+        index.drop(bind=db.get_engine())
+
+    problems = dict(
+        (name, problems)
+        for name, _, problems in model_cloudsql.explain_queries())
+    assert problems['list'] == ['full scan', 'sort']
+    assert problems['list_by_user']
+    assert not problems['read']
+    assert not problems['iterate']
+    # End the read transaction, which keeps seeing the schema it started
+    # with.
+    db.session.remove()
+
+    assert sorted(model_cloudsql.create_indexes()) == [
+        'ix_books_createdById_title', 'ix_books_title']
+    assert model_cloudsql.create_indexes() == []
+
+    for name, plan, problems in model_cloudsql.explain_queries():
+        assert not problems, (name, plan)
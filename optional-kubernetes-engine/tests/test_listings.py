@@ -0,0 +1,134 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf import listings
+from conftest import flaky_filter
+from flaky import flaky
+import mock
+import pytest
+
+
+def _titles(page):
+    return [book['title'] for book in page[0]]
+
+
+def _book(id, title, user='user'):
+    return {'id': id, 'title': title, 'createdById': user,
+            'description': 'Not kept.'}
+
+
+class TestUserListings(object):
+
+    def test_page(self):
+        user_listings = listings.UserListings(10, 100, 60)
+        assert user_listings.page('user', 0, 2) is None
+
+        assert user_listings.load('user', [
+            _book(1, 'C'), _book(2, 'A'), _book(3, 'B')])
+        page = user_listings.page('user', 0, 2)
+        assert _titles(page) == ['A', 'B']
+        assert page[1] == 2
+        assert 'description' not in page[0][0]
+        assert user_listings.page('user', 2, 2) == (
+            [{'id': 1, 'title': 'C', 'author': None, 'imageUrl': None}],
+            None)
+
+    def test_writes(self):
+        user_listings = listings.UserListings(10, 100, 60)
+        user_listings.load('user', [_book(1, 'B'), _book(2, 'D')])
+
+        user_listings.saved(_book(3, 'C'), 1)
+        user_listings.saved(_book(1, 'E'), 1)
+        user_listings.saved(_book(4, 'A', user='other'), 1)
+        assert _titles(user_listings.page('user', 0, 10)) == ['C', 'D', 'E']
+
+        user_listings.deleted(2, 1)
+        # Edited without an owner, so it's no longer the user's book.
+        user_listings.saved({'id': 3, 'title': 'C'}, 1)
+        assert _titles(user_listings.page('user', 0, 10)) == ['E']
+
+    def test_bounds(self):
+        user_listings = listings.UserListings(2, 2, 60)
+        assert not user_listings.load('big', [
+            _book(1, 'A', 'big'), _book(2, 'B', 'big'),
+            _book(3, 'C', 'big')])
+        assert user_listings.is_oversized('big')
+        assert user_listings.page('big', 0, 10) is None
+
+        for user in ('a', 'b', 'c'):
+            user_listings.load(user, [_book(user, 'A', user)])
+        assert len(user_listings) == 2
+        assert user_listings.page('a', 0, 10) is None
+
+    def test_expiry(self):
+        user_listings = listings.UserListings(10, 100, 60)
+        with mock.patch('time.time', return_value=1000):
+            user_listings.load('user', [_book(1, 'A')])
+        with mock.patch('time.time', return_value=1030):
+            assert user_listings.page('user', 0, 10)
+            # The user changed a book since the listing was loaded.
+            assert user_listings.page('user', 0, 10, changed_at=1001) is None
+        with mock.patch('time.time', return_value=1061):
+            assert user_listings.page('user', 0, 10) is None
+
+
+@flaky(rerun_filter=flaky_filter)
+@pytest.mark.usefixtures('app', 'model')
+class TestListByUser(object):
+
+    def test_list_by_user(self, model):
+        for i in range(12):
+            model.create({'title': u'Book {0:02}'.format(i),
+                          'createdById': 'user'})
+        model.create({'title': u'Other Book', 'createdById': 'other'})
+
+        books, cursor = listings.list_by_user(model, 'user')
+        assert [book['title'] for book in books] == [
+            u'Book {0:02}'.format(i) for i in range(10)]
+
+        # Later pages come from the listing, and writes update it.
+        book = model.create({'title': u'Book 10a', 'createdById': 'user'})
+        listings.book_saved(book)
+        with mock.patch.object(model, 'list_by_user') as list_by_user:
+            books, cursor = listings.list_by_user(model, 'user', cursor=cursor)
+            assert not list_by_user.called
+        assert [book['title'] for book in books] == [
+            u'Book 10', u'Book 10a', u'Book 11']
+        assert cursor is None
+
+    def test_cursor_kinds(self, model):
+        for i in range(6):
+            model.create({'title': u'Book {0}'.format(i),
+                          'createdById': 'user'})
+
+        books, cursor = listings.list_by_user(model, 'user', limit=2)
+        assert cursor.startswith('listing.')
+
+        # The user gets too many books to keep while paging through them, so
+        # the listing's offset is continued from the backend.
+        user_listings = listings.get_listings()
+        user_listings.max_books = 3
+        assert not user_listings.load(
+            'user', listings._iterate_user_books(model, 'user'))
+        books, cursor = listings.list_by_user(
+            model, 'user', limit=2, cursor=cursor.encode('utf-8'))
+        assert [book['title'] for book in books] == [u'Book 2', u'Book 3']
+        assert cursor.startswith('backend.')
+
+        # And the backend's cursor is kept once the listing can be loaded.
+        user_listings.max_books = 100
+        user_listings.load('user', listings._iterate_user_books(model, 'user'))
+        books, cursor = listings.list_by_user(
+            model, 'user', limit=2, cursor=cursor.encode('utf-8'))
+        assert [book['title'] for book in books] == [u'Book 4', u'Book 5']
@@ -0,0 +1,110 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+
+import bookshelf
+from bookshelf import profiling
+import config
+import pytest
+
+
+AUTHORIZATION = {'Authorization': 'Bearer secret'}
+
+
+@pytest.fixture
+def client():
+    app = bookshelf.create_app(
+        config,
+        testing=True,
+        config_overrides={'PROFILING_TOKEN': 'secret'})
+    return app.test_client()
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_disabled_without_token():
+    app = bookshelf.create_app(
+        config,
+        testing=True,
+        config_overrides={'PROFILING_TOKEN': None})
+    rv = app.test_client().get('/_ah/profile', headers=AUTHORIZATION)
+    assert rv.status_code == 404
+
+
+def test_requires_token(client):
+    assert client.get('/_ah/profile').status_code == 403
+    rv = client.get(
+        '/_ah/profile', headers={'Authorization': 'Bearer wrong'})
+    assert rv.status_code == 403
+
+
+def test_validates_arguments(client):
+    for query in ('mode=disk', 'seconds=-1', 'seconds=3600', 'hz=many'):
+        rv = client.get('/_ah/profile?' + query, headers=AUTHORIZATION)
+        assert rv.status_code == 400
+
+
+def test_cpu_profile(client):
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop,))
+    thread.start()
+    try:
+        rv = client.get(
+            '/_ah/profile?seconds=0.2&hz=200', headers=AUTHORIZATION)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert rv.status_code == 200
+    lines = rv.data.decode('utf-8').splitlines()
+    busy = [line for line in lines if 'busy_loop (' in line]
+    assert busy
+    stack, count = busy[0].rsplit(' ', 1)
+    assert int(count) > 0
+    # Stacks are folded from the outermost frame in.
+    assert stack.split(';')[-1].startswith('busy_loop (')
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason='requires tracemalloc')
+def test_memory_profile(client):
+    kept = []
+
+    def allocate(stop):
+        while not stop.is_set():
+            kept.append(bytearray(1024))
+            stop.wait(0.001)
+
+    stop = threading.Event()
+    thread = threading.Thread(target=allocate, args=(stop,))
+    thread.start()
+    try:
+        rv = client.get(
+            '/_ah/profile?mode=memory&seconds=0.2', headers=AUTHORIZATION)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert rv.status_code == 200
+    assert 'test_profiling.py' in rv.data.decode('utf-8')
+
+
+def test_one_profile_at_a_time(client):
+    with profiling._lock:
+        rv = client.get('/_ah/profile?seconds=0', headers=AUTHORIZATION)
+    assert rv.status_code == 409
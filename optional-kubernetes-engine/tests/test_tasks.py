@@ -0,0 +1,162 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from bookshelf import tasks
+import mock
+import pytest
+from werkzeug.exceptions import Conflict
+
+
+@pytest.fixture
+def model():
+    """This fixture replaces the model used by the tasks with a mock, so
+    that the worker logic can be tested without a database."""
+    model = mock.MagicMock()
+    with mock.patch('bookshelf.tasks.get_model', return_value=model):
+        yield model
+
+
+@pytest.fixture
+def books_api():
+    with mock.patch('bookshelf.tasks.query_books_api') as books_api:
+        books_api.return_value = {
+            'title': 'A Confederacy of Dunces',
+            'authors': ['John Kennedy Toole'],
+            'publishedDate': '1980',
+            'description': 'Ignatius',
+        }
+        yield books_api
+
+
+class TestProcessBook(object):
+
+    def test_title_fingerprint(self):
+        assert tasks.title_fingerprint(None) is None
+        assert (tasks.title_fingerprint('A  Confederacy of dunces ') ==
+                tasks.title_fingerprint('a confederacy of Dunces'))
+        assert (tasks.title_fingerprint('Book 1') !=
+                tasks.title_fingerprint('Book 2'))
+
+    def test_enriches_new_book(self, model, books_api):
+        model.read.return_value = {
+            'title': 'a confederacy of dunces',
+            'imageUrl': 'http://example.com/cover.jpg',
+        }
+
+        tasks.process_book('1')
+
+        books_api.assert_called_once_with('a confederacy of dunces')
+        book, book_id = model.update.call_args[0]
+        assert book_id == '1'
+        assert book['title'] == 'A Confederacy of Dunces'
+        assert book['author'] == 'John Kennedy Toole'
+        assert book['enrichedFingerprint'] == tasks.title_fingerprint(
+            'A Confederacy of Dunces')
+
+    def test_skips_enriched_book(self, model, books_api):
+        model.read.return_value = {
+            'title': 'A Confederacy of Dunces',
+            'description': 'Edited by the user',
+            'enrichedFingerprint': tasks.title_fingerprint(
+                'A Confederacy of Dunces'),
+        }
+
+        tasks.process_book('1')
+
+        assert not books_api.called
+        assert not model.update.called
+
+    def test_skips_stale_task(self, model, books_api):
+        model.read.return_value = {'title': 'New Title'}
+
+        tasks.process_book('1', tasks.title_fingerprint('Old Title'))
+
+        assert not books_api.called
+        assert not model.update.called
+
+    def test_records_fingerprint_without_results(self, model, books_api):
+        books_api.return_value = None
+        model.read.return_value = {'title': 'Unknown Book'}
+
+        tasks.process_book('1')
+
+        # Only the fields that changed are written.
+        changes, _ = model.update.call_args[0]
+        assert changes == {
+            'enrichedFingerprint': tasks.title_fingerprint('Unknown Book'),
+        }
+
+    def test_merges_concurrent_edit(self, model, books_api):
+        model.read.side_effect = [
+            {'title': 'a confederacy of dunces', 'version': 1},
+            # The user set the author while the Books API was queried.
+            {'title': 'a confederacy of dunces', 'author': 'J. K. Toole',
+             'version': 2},
+        ]
+        model.update.side_effect = [Conflict(), None]
+
+        tasks.process_book('1')
+
+        assert books_api.call_count == 1
+        changes, _ = model.update.call_args[0]
+        assert model.update.call_args[1] == {'version': 2}
+        assert 'author' not in changes
+        assert changes['description'] == 'Ignatius'
+
+    def test_skips_retitled_book_on_conflict(self, model, books_api):
+        model.read.side_effect = [
+            {'title': 'a confederacy of dunces', 'version': 1},
+            {'title': 'Another Book', 'version': 2},
+        ]
+        model.update.side_effect = Conflict()
+
+        tasks.process_book('1')
+
+        assert model.update.call_count == 1
+
+
+class TestTaskDebouncer(object):
+
+    def test_collapses_repeated_saves(self):
+        debouncer = tasks.TaskDebouncer(window=30)
+
+        assert debouncer.claim('1', 'a')
+        assert not debouncer.claim('1', 'a')
+        # A different book or a new title always gets its own task.
+        assert debouncer.claim('2', 'a')
+        assert debouncer.claim('1', 'b')
+
+    def test_new_task_after_enrichment(self):
+        debouncer = tasks.TaskDebouncer(window=30)
+
+        assert debouncer.claim('1', 'a')
+        # The worker enriched the book for another title, and the user set
+        # the title back within the window.
+        assert debouncer.claim('1', 'a', 'b')
+        assert not debouncer.claim('1', 'a', 'b')
+
+    def test_window_expires(self):
+        debouncer = tasks.TaskDebouncer(window=30)
+
+        with mock.patch('time.time', return_value=1000):
+            assert debouncer.claim('1', 'a')
+        with mock.patch('time.time', return_value=1031):
+            assert debouncer.claim('1', 'a')
+
+    def test_release(self):
+        debouncer = tasks.TaskDebouncer(window=30)
+
+        assert debouncer.claim('1', 'a')
+        debouncer.release('1')
+        assert debouncer.claim('1', 'a')
@@ -0,0 +1,123 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bookshelf
+from bookshelf import model_cloudsql
+import config
+from conftest import flaky_filter
+from flaky import flaky
+import pytest
+from werkzeug.exceptions import Conflict
+
+
+def check_versions(model):
+    book = model.create({'title': u'Book 1'})
+    assert book['version'] == 1
+
+    book = model.update({'title': u'Book 2'}, book['id'], version=1)
+    assert book['version'] == 2
+    with pytest.raises(Conflict):
+        model.update({'title': u'Book 3'}, book['id'], version=1)
+    assert model.read(book['id'])['title'] == u'Book 2'
+
+    # Writes without a version increment it too, and only set the fields
+    # they have.
+    book = model.update({'author': u'Author'}, book['id'])
+    assert book['version'] == 3
+    assert book['title'] == u'Book 2'
+
+    model.delete(book['id'])
+    with pytest.raises(Conflict):
+        model.update({'title': u'Book 4'}, book['id'], version=3)
+
+    return book
+
+
+@flaky(rerun_filter=flaky_filter)
+@pytest.mark.usefixtures('app', 'model')
+class TestVersions(object):
+
+    def test_versions(self, model):
+        check_versions(model)
+
+    def test_conflicting_edit(self, app, model):
+        book = model.create({'title': u'Book 1'})
+        model.update({'title': u'Book 2'}, book['id'])
+
+        with app.test_client() as c:
+            # The form was filled in before the book was changed.
+            rv = c.post('/books/{}/edit'.format(book['id']), data={
+                'title': u'Book 3', 'version': '1'})
+            assert rv.status_code == 409
+            body = rv.data.decode('utf-8')
+            assert 'Book 3' in body and 'value="2"' in body
+
+            rv = c.post('/books/{}/edit'.format(book['id']), data={
+                'title': u'Book 3', 'version': 'two'})
+            assert rv.status_code == 400
+
+            rv = c.post('/books/{}/edit'.format(book['id']), data={
+                'title': u'Book 3', 'version': '2'})
+            assert rv.status_code == 302
+
+        assert model.read(book['id'])['title'] == u'Book 3'
+
+    def test_edit_keeps_other_fields(self, app, model):
+        book = model.create({'title': u'Book 1', 'createdById': u'user'})
+
+        with app.test_client() as c:
+            rv = c.post('/books/{}/edit'.format(book['id']), data={
+                'title': u'Book 1', 'author': u'Author', 'version': '1'})
+            assert rv.status_code == 302
+
+        book = model.read(book['id'])
+        assert book['author'] == u'Author'
+        # The form doesn't have the owner, which only a full replace loses.
+        assert book['createdById'] == u'user'
+
+
+def test_cloudsql_versions(sqlite_app):
+    model_cloudsql.db.create_all()
+    check_versions(model_cloudsql)
+
+
+def test_cloudsql_read_primary(tmpdir):
+    app = bookshelf.create_app(
+        config,
+        testing=True,
+        config_overrides={
+            'DATA_BACKEND': 'cloudsql',
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + str(tmpdir.join('primary.db')),
+            'SQLALCHEMY_ENGINE_OPTIONS': {},
+            'SQLALCHEMY_BINDS': {
+                'replica': 'sqlite:///' + str(tmpdir.join('replica.db'))},
+        })
+
+    with app.app_context():
+        model_cloudsql.db.create_all()
+        replica = model_cloudsql.get_read_session()
+        assert replica is not model_cloudsql.db.session
+        # A replica that hasn't caught up with the last edit yet.
+        model_cloudsql.Book.__table__.create(
+            bind=model_cloudsql.db.get_engine(app, bind='replica'))
+        book = model_cloudsql.create({'title': u'Book 1'})
+        replica.execute(model_cloudsql.Book.__table__.insert(), [book])
+        replica.commit()
+        model_cloudsql.update({'title': u'Book 2'}, book['id'])
+
+        assert model_cloudsql.read(book['id'])['title'] == u'Book 1'
+        book = model_cloudsql.read(book['id'], primary=True)
+        assert book['title'] == u'Book 2'
+        assert book['version'] == 2